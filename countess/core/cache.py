@@ -0,0 +1,137 @@
+"""On-disk cache of pipeline node results"""
+
+import os
+import os.path
+import shutil
+import threading
+from typing import Any, Optional
+
+import dask.dataframe as dd
+import pandas as pd  # type: ignore
+
+from countess.utils.files import write_in_place
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "countess")
+DEFAULT_CACHE_SIZE = 10 * 1024**3
+
+CACHE_FILE_SUFFIX = ".parquet"
+
+
+def _entry_size(path: str) -> int:
+    """Size of a cache entry, which is a file or a directory of files"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total_size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total_size += os.path.getsize(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                pass
+    return total_size
+
+
+def _remove_entry(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.unlink(path)
+
+
+class ResultCache:
+    """Stores node results in Parquet format under `cache_dir`, named for
+    the node's cache key (see `PipelineNode.cache_key()`).  pandas
+    DataFrames are stored as a single file, and Dask DataFrames are written
+    a partition at a time to a directory and read back lazily, so results
+    never need to fit in memory.  Entries are touched whenever they are read,
+    and once the cache grows past `max_size` bytes the least recently used
+    entries are deleted, except for the entries of Dask results which this
+    cache has returned, as those are still being read from."""
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._in_use: set[str] = set()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + CACHE_FILE_SUFFIX)
+
+    def _cache_entries(self) -> list[str]:
+        return [
+            de.path
+            for de in os.scandir(self.cache_dir)
+            if de.name.endswith(CACHE_FILE_SUFFIX) and not de.name.startswith(".")
+        ]
+
+    def get(self, key: str) -> Optional[pd.DataFrame | dd.DataFrame]:
+        """Returns the cached result for `key`, or None if there isn't one.
+        Raises an exception if the cached result can't be read."""
+        filename = self._filename(key)
+        if os.path.isdir(filename):
+            result = dd.read_parquet(filename, engine="pyarrow", calculate_divisions=True)
+            with self._lock:
+                self._in_use.add(filename)
+        elif os.path.isfile(filename):
+            result = pd.read_parquet(filename, engine="pyarrow")
+        else:
+            return None
+        os.utime(filename)
+        return result
+
+    def put(self, key: str, result: Any) -> Any:
+        """Stores `result` under `key` and returns it.  Dask DataFrames are
+        computed as they're written, so what's returned instead is the same
+        data lazily read back from the cache, which saves computing it
+        again.  Anything other than a DataFrame isn't cached."""
+        filename = self._filename(key)
+        if not isinstance(result, (pd.DataFrame, dd.DataFrame)):
+            return result
+        write_in_place(filename, lambda path: result.to_parquet(path, engine="pyarrow"))
+
+        # a result which doesn't fit in the cache isn't kept in it.
+        if _entry_size(filename) > self.max_size:
+            _remove_entry(filename)
+            return result
+
+        if isinstance(result, dd.DataFrame):
+            result = dd.read_parquet(filename, engine="pyarrow", calculate_divisions=True)
+            with self._lock:
+                self._in_use.add(filename)
+        self.evict()
+        return result
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in `max_size`,
+        except for entries which are in use"""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self._cache_entries():
+            try:
+                entries.append((os.path.getmtime(path), _entry_size(path), path))
+            except FileNotFoundError:
+                pass
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if path in self._in_use:
+                continue
+            try:
+                _remove_entry(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        """Delete all cached results"""
+        for path in self._cache_entries():
+            try:
+                _remove_entry(path)
+            except FileNotFoundError:
+                pass
@@ -1,6 +1,7 @@
-import sys
+import argparse
 import time
 
+from .cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, ResultCache
 from .config import read_config
 from .logger import ConsoleLogger
 
@@ -22,7 +23,7 @@ def output_callback(output):
     print(output)
 
 
-def process_ini(config_filename):
+def process_ini(config_filename, max_workers=None, cache=None, pinned=()):
 
     logger = ConsoleLogger()
 
@@ -30,12 +31,57 @@ def process_ini(config_filename):
         config_filename,
         logger = logger,
     )
-    graph.run(logger)
+    for node in graph.nodes:
+        if node.name in pinned:
+            node.pinned = True
+    graph.run(logger, max_workers=max_workers, cache=cache)
 
 
 def main():
-    for config_filename in sys.argv[1:]:
-        process_ini(config_filename)
+    parser = argparse.ArgumentParser(description="Run CountESS pipelines without the GUI")
+    parser.add_argument("config_filenames", metavar="CONFIG", nargs="*")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="maximum number of pipeline nodes to run at once (default: based on CPU count)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help=f"directory to cache node results in (default: {DEFAULT_CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE // 1024**2,
+        help="maximum size of the result cache in megabytes",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="don't read or write cached node results"
+    )
+    parser.add_argument(
+        "--clear-cache", action="store_true", help="delete all cached node results first"
+    )
+    parser.add_argument(
+        "--pin",
+        metavar="NODE",
+        action="append",
+        default=[],
+        help="keep the result of this node in memory after its children have run (repeatable)",
+    )
+    args = parser.parse_args()
+
+    cache = None
+    if args.clear_cache or not args.no_cache:
+        cache = ResultCache(args.cache_dir, args.cache_size * 1024**2)
+        if args.clear_cache:
+            cache.clear()
+        if args.no_cache:
+            cache = None
+
+    for config_filename in args.config_filenames:
+        process_ini(config_filename, max_workers=args.workers, cache=cache, pinned=args.pin)
 
 
 if __name__ == "__main__":
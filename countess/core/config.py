@@ -58,6 +58,7 @@ def read_config(
             name=section_name,
             plugin=plugin,
             position=position,
+            pinned=config_dict.getboolean("_pinned", fallback=False),
         )
         pipeline_graph.nodes.append(node)
 
@@ -99,6 +100,8 @@ def write_config(pipeline_graph: PipelineGraph, filename: str):
             )
         if node.position:
             cp[node.name]["_position"] = " ".join(str(int(x * 1000)) for x in node.position)
+        if node.pinned:
+            cp[node.name]["_pinned"] = "true"
         for n, parent in enumerate(node.parent_nodes):
             cp[node.name][f"_parent.{n}"] = parent.name
         if node.plugin:
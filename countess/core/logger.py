@@ -57,3 +57,19 @@ class ConsoleLogger(Logger):
             message += " " + repr(detail)
 
         self.stderr.write(message + "\n")
+
+
+class MemoryLogger(Logger):
+    """A Logger which just keeps its log messages, so that they can be
+    passed back from a subprocess and then replayed into another Logger"""
+
+    def __init__(self):
+        super().__init__()
+        self.records: list[tuple[str, str, Optional[str]]] = []
+
+    def log(self, level: str, message: str, detail: Optional[str] = None):
+        self.records.append((level, message, detail))
+
+    def replay(self, logger: Logger):
+        for level, message, detail in self.records:
+            logger.log(level, message, detail)
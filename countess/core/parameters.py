@@ -3,6 +3,8 @@ import os.path
 import re
 from typing import Any, Iterable, Mapping, Optional
 
+import pandas as pd  # type: ignore
+
 PARAM_DIGEST_HASH = "sha256"
 
 
@@ -167,7 +169,9 @@ class FileParam(StringParam):
             return "0"
 
     def clean_value(self, value: str | tuple | list):
-        self._hash = self.get_file_hash()
+        # the hash is of the *new* file, so it gets recalculated lazily
+        # by get_hash_value() once the value has been updated.
+        self._hash = None
         if not value:
             return value
         try:
@@ -270,6 +274,25 @@ class DataTypeChoiceParam(ChoiceParam):
         else:
             return self.DATA_TYPES[self.value][0](value)
 
+    def cast_series(self, series: pd.Series) -> pd.Series:
+        """Casts a whole Series of strings (or None) at once, equivalent to
+        `cast_value` on each value except that strings which aren't numbers
+        become missing values rather than raising.  Integers use pandas'
+        nullable Int64 type so that they can be missing, and numbers which
+        aren't whole (or don't fit) are missing rather than truncated."""
+        if self.value is None:
+            return pd.Series(None, index=series.index, dtype=object)
+        data_type = self.get_selected_type()
+        if data_type is int:
+            numbers = pd.to_numeric(series, errors="coerce")
+            return numbers.where((numbers % 1 == 0) & (numbers.abs() < 2**63)).astype("Int64")
+        elif data_type is float:
+            return pd.to_numeric(series, errors="coerce").astype("float64")
+        elif data_type is bool:
+            return series.map(bool, na_action="ignore")
+        else:
+            return series
+
 
 class DataTypeOrNoneChoiceParam(DataTypeChoiceParam):
     NONE_VALUE = "— NONE —"
@@ -279,6 +302,7 @@ class DataTypeOrNoneChoiceParam(DataTypeChoiceParam):
         "number": (float, None),
         "integer": (int, 0),
         "boolean": (bool, None),
+        "category": (str, None),
         NONE_VALUE: None,
     }
 
@@ -303,6 +327,28 @@ class DataTypeOrNoneChoiceParam(DataTypeChoiceParam):
         else:
             return super().cast_value(value)
 
+    def cast_series(self, series: pd.Series) -> pd.Series:
+        if self.value == self.NONE_VALUE:
+            return pd.Series(None, index=series.index, dtype=object)
+        elif self.value == "category":
+            return series.astype("category")
+        else:
+            return super().cast_series(series)
+
+    def get_selected_dtype(self):
+        """Returns the selected type in a form suitable for pandas `dtype`
+        arguments.  Categoricals are distinguished from strings, and integers
+        and booleans use pandas' nullable types so missing values don't stop
+        them being parsed."""
+        if self.value == "category":
+            return "category"
+        elif self.value == "integer":
+            return "Int64"
+        elif self.value == "boolean":
+            return "boolean"
+        else:
+            return self.get_selected_type()
+
     def is_none(self):
         return self.value == self.NONE_VALUE
 
@@ -1,13 +1,56 @@
+import hashlib
 import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 
+import dask.dataframe as dd
+
+from countess.core.cache import ResultCache
 from countess.core.logger import Logger
 from countess.core.plugins import BasePlugin, get_plugin_classes
+from countess.utils.dask import dataframe_memory_usage
 
 PRERUN_ROW_LIMIT = 10000
 
 
+class PipelineGraphError(ValueError):
+    """Raised when the pipeline graph isn't a valid directed acyclic graph"""
+
+
+def topological_sort(nodes: Iterable["PipelineNode"]) -> list["PipelineNode"]:
+    """Sort `nodes` so that every node comes after all of its parents, using
+    Kahn's algorithm.  Raises PipelineGraphError if a node has a parent which
+    isn't in `nodes` or if the nodes contain a cycle."""
+    nodes = list(nodes)
+    waiting = {node: len(node.parent_nodes) for node in nodes}
+
+    for node in nodes:
+        missing = [p.name for p in node.parent_nodes if p not in waiting]
+        if missing:
+            raise PipelineGraphError(
+                f"Node {node.name} has parents which aren't in the graph: {', '.join(missing)}"
+            )
+
+    ready = deque(node for node in nodes if waiting[node] == 0)
+    ordered = []
+    while ready:
+        node = ready.popleft()
+        ordered.append(node)
+        for child_node in node.child_nodes:
+            if child_node in waiting:
+                waiting[child_node] -= 1
+                if waiting[child_node] == 0:
+                    ready.append(child_node)
+
+    if len(ordered) < len(nodes):
+        cycle_names = sorted(node.name for node, count in waiting.items() if count > 0)
+        raise PipelineGraphError(f"Pipeline graph contains a cycle: {', '.join(cycle_names)}")
+
+    return ordered
+
+
 @dataclass
 class PipelineNode:
     name: str
@@ -17,19 +60,55 @@ class PipelineNode:
     child_nodes: set["PipelineNode"] = field(default_factory=set)
     result: Any = None
     is_dirty: bool = True
+    pinned: bool = False
+
+    # reachability caches, cleared whenever an edge is added or removed.
+    _ancestors: Optional[frozenset["PipelineNode"]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _descendants: Optional[frozenset["PipelineNode"]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     def __hash__(self):
         return id(self)
 
+    @staticmethod
+    def _reachable(node, attr):
+        found = set()
+        stack = list(getattr(node, attr))
+        while stack:
+            other = stack.pop()
+            if other not in found:
+                found.add(other)
+                stack.extend(getattr(other, attr))
+        return frozenset(found)
+
+    def ancestors(self) -> frozenset["PipelineNode"]:
+        """All nodes upstream of this node"""
+        if self._ancestors is None:
+            self._ancestors = self._reachable(self, "parent_nodes")
+        return self._ancestors
+
+    def descendants(self) -> frozenset["PipelineNode"]:
+        """All nodes downstream of this node"""
+        if self._descendants is None:
+            self._descendants = self._reachable(self, "child_nodes")
+        return self._descendants
+
+    def _edge_changed(self, parent):
+        """An edge from `parent` to `self` has been added or removed, so
+        reset the reachability caches which might have included it."""
+        for node in self.descendants() | {self}:
+            node._ancestors = None
+        for node in parent.ancestors() | {parent}:
+            node._descendants = None
+
     def is_ancestor_of(self, node):
-        return (self in node.parent_nodes) or any(
-            (self.is_ancestor_of(n) for n in node.parent_nodes)
-        )
+        return self in node.ancestors()
 
     def is_descendant_of(self, node):
-        return (self in node.child_nodes) or any(
-            (self.is_descendant_of(n) for n in node.child_nodes)
-        )
+        return self in node.descendants()
 
     def get_input_data(self):
         if len(self.parent_nodes) == 0:
@@ -42,8 +121,45 @@ class PipelineNode:
     def exception_logger(self, exception, logger: Logger):
         logger.error(str(exception), detail="".join(traceback.format_exception(exception)))
 
-    def execute(self, logger: Logger, row_limit=None):
+    def cache_key(self) -> str:
+        """A key for this node's result which changes whenever the plugin,
+        its configuration (including the contents of any input files) or the
+        cache keys of any of its parents change."""
+        cache_keys: dict[PipelineNode, str] = {}
+        for node in self.get_ancestor_list([self]):
+            digest = hashlib.sha256()
+            if node.plugin:
+                digest.update(node.plugin.__module__.encode("utf-8") + b"\0")
+                digest.update(node.plugin.__class__.__name__.encode("utf-8") + b"\0")
+                digest.update(node.plugin.version.encode("utf-8") + b"\0")
+                digest.update(node.plugin.hash().encode("utf-8") + b"\0")
+            for parent_node in sorted(node.parent_nodes, key=lambda n: n.name):
+                digest.update(parent_node.name.encode("utf-8") + b"\0")
+                digest.update(cache_keys[parent_node].encode("utf-8") + b"\0")
+            cache_keys[node] = digest.hexdigest()
+        return cache_keys[self]
+
+    def execute(self, logger: Logger, row_limit=None, cache: Optional[ResultCache] = None):
+        """Run the plugin on the parent nodes' results.  If a `cache` is
+        supplied, full runs (`row_limit=None`) load the result from the
+        cache if it is present and store it if it is not."""
         assert row_limit is None or isinstance(row_limit, int)
+        if row_limit is not None or self.plugin is None:
+            cache = None
+        if cache is not None:
+            # the cache is only an optimization, so results which can't be
+            # read from it are recalculated and results which can't be
+            # written to it are used anyway.
+            cache_key = self.cache_key()
+            try:
+                self.result = cache.get(cache_key)
+            except Exception as exc:  # pylint: disable=W0718
+                logger.warning(f"{self.name}: can't read from cache", detail=repr(exc))
+                self.result = None
+            if self.result is not None:
+                logger.info(f"{self.name}: loaded from cache")
+                return
+
         input_data = self.get_input_data()
         if self.plugin:
             try:
@@ -51,6 +167,12 @@ class PipelineNode:
             except Exception as exc:  # pylint: disable=W0718
                 self.result = None
                 self.exception_logger(exc, logger)
+                return
+            if cache is not None:
+                try:
+                    self.result = cache.put(cache_key, self.result)
+                except Exception as exc:  # pylint: disable=W0718
+                    logger.warning(f"{self.name}: can't write to cache", detail=repr(exc))
         else:
             self.result = input_data
 
@@ -83,11 +205,13 @@ class PipelineNode:
     def add_parent(self, parent):
         self.parent_nodes.add(parent)
         parent.child_nodes.add(self)
+        self._edge_changed(parent)
         self.mark_dirty()
 
     def del_parent(self, parent):
         self.parent_nodes.discard(parent)
         parent.child_nodes.discard(self)
+        self._edge_changed(parent)
         self.mark_dirty()
 
     def configure_plugin(self, key, value):
@@ -96,24 +220,22 @@ class PipelineNode:
 
     def final_descendants(self):
         if self.child_nodes:
-            return set(n2 for n1 in self.child_nodes for n2 in n1.final_descendants())
+            return set(n for n in self.descendants() if not n.child_nodes)
         else:
-            return set(self)
+            return {self}
 
     def detatch(self):
-        for parent_node in self.parent_nodes:
-            parent_node.child_nodes.discard(self)
-        for child_node in self.child_nodes:
-            child_node.parent_nodes.discard(self)
+        for parent_node in list(self.parent_nodes):
+            self.del_parent(parent_node)
+        for child_node in list(self.child_nodes):
+            child_node.del_parent(self)
 
     @classmethod
     def get_ancestor_list(cls, nodes):
         """Given a bunch of nodes, find the list of all the ancestors in a
         sensible order"""
-        parents = set((p for n in nodes for p in n.parent_nodes))
-        if not parents:
-            return list(nodes)
-        return cls.get_ancestor_list(parents) + list(nodes)
+        nodes = set(nodes)
+        return topological_sort(nodes.union(*(n.ancestors() for n in nodes)))
 
 
 class PipelineGraph:
@@ -131,25 +253,99 @@ class PipelineGraph:
         self.nodes.remove(node)
 
     def traverse_nodes(self):
-        found_nodes = set(node for node in self.nodes if not node.parent_nodes)
-        yield from found_nodes
-
-        while len(found_nodes) < len(self.nodes):
-            for node in self.nodes:
-                if node not in found_nodes and node.parent_nodes.issubset(found_nodes):
-                    yield node
-                    found_nodes.add(node)
-
-    def run(self, logger):
-        # XXX this is the last thing PipelineGraph actually does!
-        # might be easier to just keep a set of nodes and sort through
-        # them for output nodes, or something.
-
-        for node in self.traverse_nodes():
-            # XXX TODO there's some opportunity for easy parallelization here,
-            # by pushing each node into a pool as soon as its parents are
-            # complete.
-            node.execute(logger)
+        """Yields every node after all of its parents.  Raises
+        PipelineGraphError if the graph contains a cycle."""
+        yield from topological_sort(self.nodes)
+
+    def run(
+        self,
+        logger,
+        max_workers: Optional[int] = None,
+        cache: Optional[ResultCache] = None,
+    ):
+        """Run every node in the graph.  Each node is submitted to a thread
+        pool as soon as all of its parents have finished, so independent
+        branches (eg: several input files feeding a join) run concurrently.
+        `max_workers` is passed through to the ThreadPoolExecutor, so
+        `max_workers=1` runs the nodes one at a time.  If `cache` is supplied,
+        node results are loaded from / stored to it.
+
+        Once all of a node's children have run its result is released, unless
+        it is a final output (has no children) or `pinned` is set, so peak
+        memory use is only that of the results still needed.  Memory use is
+        estimated from the sizes of pandas results.  Dask results are lazy
+        and count as nothing, but they keep the results they were built
+        from in use, so those don't count as released until they are."""
+
+        waiting = {node: len(node.parent_nodes) for node in self.traverse_nodes()}
+        consumers = {node: len(node.child_nodes) for node in waiting}
+
+        result_sizes: dict[PipelineNode, int] = {}
+        live_size = peak_size = total_size = 0
+
+        # released results which are still in use, and the nodes using them
+        users: dict[PipelineNode, set[PipelineNode]] = {}
+
+        def release(node, result):
+            node_users = set(
+                child_node
+                for child_node in node.child_nodes
+                if isinstance(child_node.result, dd.DataFrame) or child_node.result is result
+            )
+            if node_users:
+                users[node] = node_users
+            else:
+                free(node)
+
+        def free(node):
+            nonlocal live_size
+            live_size -= result_sizes[node]
+            for other_node in list(users):
+                if other_node in users:
+                    users[other_node].discard(node)
+                    if not users[other_node]:
+                        del users[other_node]
+                        free(other_node)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+            def submit(node):
+                running[executor.submit(node.execute, logger, None, cache)] = node
+
+            running: dict[Future, PipelineNode] = {}
+            for node, num_parents in waiting.items():
+                if num_parents == 0:
+                    submit(node)
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    future.result()
+
+                    result_sizes[node] = dataframe_memory_usage(node.result)
+                    live_size += result_sizes[node]
+                    total_size += result_sizes[node]
+                    peak_size = max(peak_size, live_size)
+
+                    for parent_node in node.parent_nodes:
+                        consumers[parent_node] -= 1
+                        if consumers[parent_node] == 0 and not parent_node.pinned:
+                            result = parent_node.result
+                            parent_node.result = None
+                            parent_node.is_dirty = True
+                            release(parent_node, result)
+
+                    for child_node in node.child_nodes:
+                        waiting[child_node] -= 1
+                        if waiting[child_node] == 0:
+                            submit(child_node)
+
+        saved_size = total_size - peak_size
+        logger.info(
+            f"Estimated peak result memory {peak_size / 1024**2:.1f} MiB "
+            f"({saved_size / 1024**2:.1f} MiB saved by releasing intermediate results)"
+        )
 
     def reset(self):
         for node in self.nodes:
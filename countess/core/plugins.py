@@ -18,20 +18,24 @@ import hashlib
 import importlib
 import importlib.metadata
 import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from collections.abc import Iterable, Mapping, MutableMapping
-from typing import Any, List, Optional
+from typing import Any, Optional
 
 import dask.dataframe as dd
 import numpy as np
 import pandas as pd  # type: ignore
 from dask.callbacks import Callback
 
-from countess.core.logger import Logger
-from countess.core.parameters import (ArrayParam, BaseParam, ChoiceParam,
-                                      ColumnChoiceParam,
-                                      FileArrayParam,
-                                      FileParam, MultiParam, StringParam)
+from countess.core.logger import Logger, MemoryLogger
+from countess.core.parameters import (ArrayParam, BaseParam,
+                                      ColumnChoiceParam, FileArrayParam,
+                                      FileParam, FloatParam, MultiParam,
+                                      StringParam)
 from countess.utils.dask import concat_dataframes, crop_dataframe
+from countess.utils.isolation import START_METHOD
 
 
 PRERUN_ROW_LIMIT = 100
@@ -246,10 +250,28 @@ class DaskBasePlugin(BasePlugin):
 # provide progress feedback.
 
 
+def _file_size(filename: str) -> int:
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def _read_file_in_subprocess(plugin, file_param, row_limit):
+    memory_logger = MemoryLogger()
+    df = plugin.read_file_to_dataframe(file_param, memory_logger, row_limit)
+    return df, memory_logger
+
+
 class DaskInputPlugin(FileInputMixin, DaskBasePlugin):
     """A specialization of the DaskBasePlugin to allow it to follow nothing,
     eg: come first."""
 
+    # When there's more than one file, the number of processes to read
+    # them with: 1 reads them one at a time in this process, None uses a
+    # process per CPU.  Only worth it when parsing files is CPU bound.
+    max_processes: Optional[int] = 1
+
     def __init__(self, *a, **k):
         # Add in filenames
         super().__init__(*a, **k)
@@ -285,18 +307,28 @@ class DaskInputPlugin(FileInputMixin, DaskBasePlugin):
                 ddf = self.combine_dfs([ddf])
         else:
             num_files = len(fps)
-            # Input plugins are likely I/O bound so if there's more than one
-            # file, instead of using the Dask progress callback mechanism
-            # this uses a simple count of files read."""
+            # If there's more than one file, instead of using the Dask progress
+            # callback mechanism this reports the number of files which have
+            # been read and the proportion of the total size which they make
+            # up.  Files are read whole, so progress only moves as each one
+            # is finished.
             per_file_row_limit = int(row_limit / len(fps) + 1) if row_limit else None
-            logger.progress("Loading", 0)
-            dfs = []
-            for num, fp in enumerate(fps):
-                assert isinstance(fp, MultiParam)
-                df = self.read_file_to_dataframe(fp, logger, per_file_row_limit)
-                dfs.append(df)
-                logger.progress("Loading", 100 * (num + 1) // (num_files + 1))
-            logger.progress("Combining", 100 * num_files // num_files + 1)
+            file_sizes = [_file_size(fp.value["filename"]) for fp in fps]
+            total_size = sum(file_sizes) or 1
+            logger.progress(f"Loaded 0/{num_files} files", 0)
+
+            dfs: list[Any] = [None] * num_files
+            done_size = 0
+            for num_done, (num, df) in enumerate(
+                self._read_files(fps, logger, per_file_row_limit), 1
+            ):
+                dfs[num] = df
+                done_size += file_sizes[num]
+                logger.progress(
+                    f"Loaded {num_done}/{num_files} files", 99 * done_size // total_size
+                )
+
+            logger.progress("Combining", 99)
             ddf = self.combine_dfs(dfs)
             logger.progress("Done", 100)
 
@@ -307,6 +339,32 @@ class DaskInputPlugin(FileInputMixin, DaskBasePlugin):
     ) -> dd.DataFrame | pd.DataFrame:
         raise NotImplementedError(f"Implement {self.__class__.__name__}.read_file_to_dataframe")
 
+    def _read_files(self, fps, logger: Logger, row_limit: Optional[int] = None):
+        """Reads each file parameter in `fps`, yielding `(num, df)` as each
+        file is finished with, not necessarily in order.  Full runs of plugins
+        which set `max_processes` read the files in a pool of processes.  The
+        GUI's preruns are always read in this process, as
+        `read_file_to_dataframe` may update parameters."""
+
+        if row_limit is not None or self.max_processes == 1:
+            for num, fp in enumerate(fps):
+                yield num, self.read_file_to_dataframe(fp, logger, row_limit)
+            return
+
+        # worker processes aren't forked from this one, as that's not safe
+        # while other threads (eg: Dask's) hold locks.
+        max_workers = min(self.max_processes or os.cpu_count() or 1, len(fps))
+        mp_context = multiprocessing.get_context(START_METHOD)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            futures = {
+                executor.submit(_read_file_in_subprocess, self, fp, row_limit): num
+                for num, fp in enumerate(fps)
+            }
+            for future in as_completed(futures):
+                df, memory_logger = future.result()
+                memory_logger.replay(logger)
+                yield futures[future], df
+
 
 def _set_column_choice_params(parameter, column_names):
     if isinstance(parameter, ArrayParam):
@@ -333,12 +391,14 @@ class DaskTransformPlugin(DaskBasePlugin):
 
 
 class DaskScoringPlugin(DaskTransformPlugin):
-    """Specific kind of transform which turns counts into scores"""
+    """Specific kind of transform which turns counts into scores.  Subclasses
+    implement `score_matrix()`, which scores a whole partition at once.
+    All of the scores are calculated in one pass over each partition.
+    Scores which aren't finite (eg: from counts of zero) become NaN, and
+    rows where every score is NaN are dropped."""
 
     # XXX not really useful?
 
-    max_counts = 5
-
     parameters = {
         "scores": ArrayParam(
             "Scores",
@@ -346,36 +406,53 @@ class DaskScoringPlugin(DaskTransformPlugin):
                 "Score",
                 {
                     "score": StringParam("Score Column"),
-                    "counts": ArrayParam(
-                        "Counts", ChoiceParam("Column"), min_size=2, max_size=max_counts
-                    ),
+                    "counts": ArrayParam("Counts", ColumnChoiceParam("Column"), min_size=2),
                 },
             ),
             min_size=1,
-        )
+        ),
+        "pseudocount": FloatParam("Pseudocount", 0),
     }
 
-    def prepare_dask(self, data, logger):
-        super().prepare(data, logger)
-        for pp in self.parameters["scores"]:
-            for ppp in pp.counts:
-                ppp.choices = self.input_columns
+    def score_matrix(self, counts: np.ndarray) -> np.ndarray:
+        """Scores each row of `counts`, a 2D array of floats with a column
+        for each count column, in order, with the pseudocount already added.
+        Returns a 1D array of scores."""
+        raise NotImplementedError("Subclass DaskScoringPlugin and provide a score_matrix() method")
 
-    def run_dask(self, data: dd.DataFrame, logger: Logger) -> dd.DataFrame:
-        assert isinstance(self.parameters["scores"], ArrayParam)
-        score_cols = []
-        for pp in self.parameters["scores"]:
-            scol = pp.score.value
-            ccols = [ppp.value for ppp in pp.counts]
+    def score_dataframe(self, df: pd.DataFrame, scores: list[tuple[str, list[str]]]):
+        count_columns = sorted(set(column for _, columns in scores for column in columns))
+        counts = df[count_columns].to_numpy(dtype=float, copy=True)
+        counts += self.parameters["pseudocount"].value
 
-            if scol and all(ccols):
-                data[scol] = self.score([data[col] for col in ccols])
-                score_cols.append(scol)
+        values = np.empty((len(df), len(scores)))
+        with np.errstate(all="ignore"):
+            for num, (_, columns) in enumerate(scores):
+                values[:, num] = self.score_matrix(
+                    counts[:, [count_columns.index(column) for column in columns]]
+                )
+        values[~np.isfinite(values)] = np.nan
 
-        return data.replace([np.inf, -np.inf], np.nan).dropna(how="all", subset=score_cols)
+        df = df.assign(**dict((score, values[:, num]) for num, (score, _) in enumerate(scores)))
+        return df[~np.isnan(values).all(axis=1)]
 
-    def score(self, columns: List[dd.Series]) -> dd.Series:
-        raise NotImplementedError("Subclass DaskScoringPlugin and provide a score() method")
+    def run_dask(
+        self, data: pd.DataFrame | dd.DataFrame, logger: Logger
+    ) -> pd.DataFrame | dd.DataFrame:
+        assert isinstance(self.parameters["scores"], ArrayParam)
+        scores = []
+        for pp in self.parameters["scores"]:
+            score_column = pp["score"].value
+            count_columns = [ppp.value for ppp in pp["counts"]]
+            if score_column and all(count_columns):
+                scores.append((score_column, count_columns))
+
+        if not scores:
+            return data
+        if isinstance(data, dd.DataFrame):
+            meta = self.score_dataframe(data._meta, scores)
+            return data.map_partitions(self.score_dataframe, scores, meta=meta)
+        return self.score_dataframe(data, scores)
 
 
 class DaskReindexPlugin(DaskTransformPlugin):
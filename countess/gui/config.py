@@ -481,11 +481,21 @@ class DataFramePreview:
             self.update(ddf)
 
     def update(self, ddf: dd.DataFrame):
-        if len(ddf) > 1000:
-            self.label["text"] = f"DataFrame Preview (1000 rows out of {len(ddf)})"
-            ddf = crop_dataframe(ddf, 1000)
+        if isinstance(ddf, dd.DataFrame):
+            # Counting the rows of a Dask dataframe would mean computing the
+            # whole thing, so just compute enough rows to tell if there's more.
+            df = ddf.head(1001, npartitions=-1)
+            num_rows = f"{len(df)}" if len(df) <= 1000 else "unknown"
         else:
-            self.label["text"] = f"DataFrame Preview {len(ddf)} rows"
+            df = ddf
+            num_rows = f"{len(df)}"
+
+        if len(df) > 1000:
+            self.label["text"] = f"DataFrame Preview (1000 rows out of {num_rows})"
+            ddf = crop_dataframe(df, 1000)
+        else:
+            self.label["text"] = f"DataFrame Preview {num_rows} rows"
+            ddf = df
 
         # XXX could handle multiindex columns more elegantly than this
         # (but maybe not in a ttk.Treeview)
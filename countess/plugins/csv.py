@@ -1,35 +1,62 @@
 import csv
+import io
+import os
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Callable, Optional
 
+import dask
 import dask.dataframe as dd
 import numpy as np
 import pandas as pd  # type: ignore
 
 from countess import VERSION
 from countess.core.parameters import *
-from countess.core.plugins import DaskBasePlugin, DaskInputPlugin
+from countess.core.plugins import DaskBasePlugin, DaskInputPlugin, DaskProgressCallback
+from countess.utils.compression import COMPRESSION_EXTENSIONS, compress_bytes
+from countess.utils.dask import concat_dataframes
+from countess.utils.files import read_file_block, split_file_lines, write_in_place
 
-# XXX it would be better to do the same this Regex Tool does and get the user to assign
-# data types to each column
+# Column types are guessed from this many rows at the start of the file.
+SAMPLE_ROWS = 1000
 
+# Text columns with no more than this proportion of distinct values in the
+# sample are loaded as categoricals.
+CATEGORY_MAX_RATIO = 0.1
 
-def maybe_number(x):
-    """CSV is never clear on if something is actually a number so ... try it I guess ..."""
-    try:
-        return int(x)
-    except ValueError:
-        pass
 
-    try:
-        return float(x)
-    except ValueError:
-        pass
+def infer_column_type(values: pd.Series) -> str:
+    """Proposes a DataTypeOrNoneChoiceParam type for a sample of a column,
+    read as strings."""
+    present_values = values.dropna()
+    if len(present_values) == 0:
+        return "string"
+    if present_values.str.lower().isin(["true", "false"]).all():
+        return "boolean"
 
-    return x
+    numbers = pd.to_numeric(present_values, errors="coerce")
+    if numbers.notna().all():
+        # integer columns can't have missing values.
+        if pd.api.types.is_integer_dtype(numbers) and len(present_values) == len(values):
+            return "integer"
+        return "number"
 
+    if present_values.nunique() <= CATEGORY_MAX_RATIO * len(present_values):
+        return "category"
+    return "string"
 
-def clean_row(row):
-    return [maybe_number(x) for x in row]
+
+# Files bigger than this are split into blocks of about this size at line
+# boundaries, and the blocks are parsed in parallel.
+CSV_BLOCK_SIZE = 64 * 1024 * 1024
+
+# pandas infers compression from these extensions, and compressed files
+# can't be split.
+COMPRESSED_EXTENSIONS = (".gz", ".bz2", ".zip", ".xz", ".zst", ".tar")
+
+
+def read_csv_block(filename: str, start: int, end: int, options: dict) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(read_file_block(filename, start, end)), **options)
 
 
 class LoadCsvPlugin(DaskInputPlugin):
@@ -66,22 +93,9 @@ class LoadCsvPlugin(DaskInputPlugin):
     def read_file_to_dataframe(self, file_param, logger, row_limit=None):
         filename = file_param["filename"].value
 
-        options = {
+        options: dict[str, Any] = {
             "header": 0 if self.parameters["header"].value else None,
         }
-        if row_limit is not None:
-            options["nrows"] = row_limit
-
-        if len(self.parameters["columns"]):
-            options["names"] = []
-            options["dtype"] = {}
-            options["usecols"] = []
-
-            for n, pp in enumerate(self.parameters["columns"]):
-                options["names"].append(pp["name"].value or f"column_{n}")
-                if not pp["type"].is_none():
-                    options["dtype"][n] = pp["type"].get_selected_type()
-                    options["usecols"].append(n)
 
         delimiter = self.parameters["delimiter"].value
         if delimiter == "TAB":
@@ -106,10 +120,49 @@ class LoadCsvPlugin(DaskInputPlugin):
         if comment != "None":
             options["comment"] = comment
 
+        if not len(self.parameters["columns"]):
+            self.infer_columns(filename, options)
+
+        if row_limit is not None:
+            options["nrows"] = row_limit
+
+        if len(self.parameters["columns"]):
+            options["names"] = []
+            options["dtype"] = {}
+            options["usecols"] = []
+
+            for n, pp in enumerate(self.parameters["columns"]):
+                options["names"].append(pp["name"].value or f"column_{n}")
+                if not pp["type"].is_none():
+                    options["dtype"][n] = pp["type"].get_selected_dtype()
+                    options["usecols"].append(n)
+
         # XXX dd.read_csv().set_index() is very very slow!
         # XXX pd.read_csv(index_col=) is half the speed of pd.read_csv().set_index()
 
-        df = pd.read_csv(filename, **options)
+        # Big files are split into blocks which are parsed in parallel threads
+        # (the pandas C parser releases the GIL while tokenizing).  This can't
+        # be done if quoted values might contain newlines, or if the file is
+        # compressed, or for previews which only read the first few rows.
+        split_blocks = (
+            row_limit is None
+            and quoting == "None"
+            and not filename.endswith(COMPRESSED_EXTENSIONS)
+            and os.path.getsize(filename) > CSV_BLOCK_SIZE
+        )
+        try:
+            df = self.read_csv(filename, options, split_blocks)
+        except (ValueError, TypeError) as exc:
+            # column types are guessed from the start of the file, and
+            # values further on might not fit them, in which case pandas
+            # is left to work out the types of numeric columns.
+            if not options.get("dtype"):
+                raise
+            logger.warning(f"Column types don't fit all of {filename}", detail=str(exc))
+            options["dtype"] = dict(
+                (n, dtype) for n, dtype in options["dtype"].items() if dtype in (str, "category")
+            )
+            df = self.read_csv(filename, options, split_blocks)
 
         while len(df.columns) > len(self.parameters["columns"]):
             self.parameters["columns"].add_row()
@@ -131,17 +184,90 @@ class LoadCsvPlugin(DaskInputPlugin):
 
         return df
 
+    def read_csv(self, filename: str, options: dict, split_blocks: bool) -> pd.DataFrame:
+        if split_blocks:
+            return self.read_csv_blocks(filename, options)
+        return pd.read_csv(filename, **options)
+
+    def infer_columns(self, filename: str, options: dict):
+        """Reads the first few rows of `filename` as strings and fills in the
+        `columns` parameter with their names and a guess at their types, so
+        that the whole file can be parsed straight into typed columns."""
+        assert isinstance(self.parameters["columns"], ArrayParam)
+        sample_df = pd.read_csv(filename, nrows=SAMPLE_ROWS, dtype=str, **options)
+
+        for n, column_name in enumerate(sample_df.columns):
+            pp = self.parameters["columns"][n]
+            if self.parameters["header"].value:
+                pp["name"].value = str(column_name)
+            pp["type"].value = infer_column_type(sample_df[column_name])
+
+    def read_csv_blocks(self, filename: str, options: dict) -> pd.DataFrame:
+        blocks = split_file_lines(filename, CSV_BLOCK_SIZE)
+
+        # only the first block has the header row, so the other blocks
+        # need to be told the column names.
+        first_df = read_csv_block(filename, blocks[0][0], blocks[0][1], options)
+        other_options = dict(options, header=None)
+        if "names" not in other_options:
+            other_options["names"] = list(first_df.columns)
+
+        with ThreadPoolExecutor() as executor:
+            other_dfs = list(
+                executor.map(
+                    lambda block: read_csv_block(filename, block[0], block[1], other_options),
+                    blocks[1:],
+                )
+            )
+
+        df = pd.concat([first_df] + other_dfs, ignore_index=True)
+
+        # concatenating categoricals with different categories makes them objects
+        for column_name, dtype in first_df.dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype) and df[column_name].dtype != dtype:
+                df[column_name] = df[column_name].astype("category")
+
+        return df
+
+
+def _csv_bytes(df: pd.DataFrame, header: bool, compression: Optional[str]) -> bytes:
+    return compress_bytes(df.to_csv(header=header).encode("utf-8"), compression)
+
+
+def _write_file(filename: str, data: bytes):
+    with open(filename, "wb") as fh:
+        fh.write(data)
+
+
+def _append_file(filename: str, data: bytes, _previous: Any = None):
+    """Appends `data` to `filename`.  `_previous` is only there so that
+    appends can be made to wait for each other."""
+    with open(filename, "ab") as fh:
+        fh.write(data)
+
+
+def _write_csv_file(df: pd.DataFrame, filename: str, header: bool, compression: Optional[str]):
+    write_in_place(filename, lambda path: _write_file(path, _csv_bytes(df, header, compression)))
+
 
 class SaveCsvPlugin(DaskBasePlugin):
+    """Saves to CSV, optionally compressed.  Output goes to a temporary file
+    which is renamed into place once it is complete, so a failed run never
+    leaves a partly written file behind.  Partitions of Dask DataFrames are
+    converted to CSV and compressed in parallel, and either written in order
+    to a single file or each written to its own file."""
+
     name = "CSV Save"
     title = "Save to CSV"
     description = "CSV CSV CSV"
 
-    file_types = [("CSV", "*.csv")]
+    file_types = [("CSV", "*.csv"), ("CSV (gzipped)", "*.csv.gz"), ("CSV (zstd)", "*.csv.zst")]
 
     parameters = {
         "header": BooleanParam("CSV header row?", True),
         "filename": FileSaveParam("Filename", file_types=file_types),
+        "compression": ChoiceParam("Compression", "None", choices=["None", "gzip", "zstd"]),
+        "per_partition": BooleanParam("One file per partition?", False),
     }
 
     def run(
@@ -153,11 +279,55 @@ class SaveCsvPlugin(DaskBasePlugin):
         assert isinstance(self.parameters["filename"], StringParam)
 
         filename = self.parameters["filename"].value
-
-        if row_limit is None:
-            if isinstance(obj, dd.DataFrame):
-                obj.to_csv(filename, single_file=True, compute=True)
-            else:
-                obj.to_csv(filename)
-
+        header = self.parameters["header"].value
+        compression = self.parameters["compression"].value
+        if compression == "None":
+            compression = None
+
+        if row_limit is not None or not filename:
+            return None
+
+        extension = COMPRESSION_EXTENSIONS.get(compression, "")
+        if extension and not filename.endswith(extension):
+            filename += extension
+
+        # multiple inputs are written to the same file
+        if isinstance(obj, Mapping):
+            obj = concat_dataframes(list(obj.values()))
+
+        partitions = obj.to_delayed() if isinstance(obj, dd.DataFrame) else [obj]
+
+        if self.parameters["per_partition"].value:
+            # each partition gets its own file, named by replacing "*" in
+            # the filename with the partition number.
+            if "*" not in filename:
+                dirname, basename = os.path.split(filename)
+                base, dot, ext = basename.partition(".")
+                filename = os.path.join(dirname, f"{base}-*{dot}{ext}")
+            width = len(str(len(partitions) - 1))
+            dask.compute(
+                *[
+                    dask.delayed(_write_csv_file)(
+                        partition, filename.replace("*", f"{num:0{width}d}"), header, compression
+                    )
+                    for num, partition in enumerate(partitions)
+                ]
+            )
+        else:
+            # partitions are converted and compressed in parallel, and each
+            # write waits for the one before so they're written in order.
+            # The whole thing is one graph so that anything upstream which
+            # partitions share (eg: a shuffle) is only computed once.  Only
+            # the first partition has a header row.
+            def write_partitions(path: str):
+                written = None
+                for num, partition in enumerate(partitions):
+                    data = dask.delayed(_csv_bytes)(partition, header and num == 0, compression)
+                    written = dask.delayed(_append_file)(path, data, written)
+                with DaskProgressCallback(logger):
+                    dask.compute(written)
+
+            write_in_place(filename, write_partitions)
+
+        logger.progress("Done", 100)
         return None
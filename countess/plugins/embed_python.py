@@ -1,44 +1,273 @@
+import ast
+import builtins
+import functools
+import math
+from typing import Iterable, Optional
+
 import dask.dataframe as dd
+import numpy as np
 import pandas as pd  # type: ignore
+from dask.dataframe.utils import meta_nonempty
 
 from countess import VERSION
 from countess.core.logger import Logger
-from countess.core.parameters import ArrayParam, TextParam
+from countess.core.parameters import ArrayParam, BooleanParam, IntegerParam, TextParam
 from countess.core.plugins import DaskTransformPlugin
+from countess.utils.isolation import ResourceLimitError, run_isolated
+from countess.utils.sequence import unpack_sequences
 
+# modules and functions which code can use without importing them
+CODE_GLOBALS = {"math": math, "np": np, "pd": pd, "unpack_sequences": unpack_sequences}
 
-def process(df: pd.DataFrame, codes):
-    for code in codes:
-        result = df.eval(code)
-        if isinstance(result, (dd.Series, pd.Series)):
-            # this was a filter
-            df["_filter"] = result
-            df = df.query("_filter").drop(columns="_filter")
-        else:
-            # this was a column assignment
-            df = result
+FILTER_PREFIX = "__filter_"
+
+
+class _ElementwiseLogic(ast.NodeTransformer):
+    """`and`, `or` and `not` don't work element-wise on columns so, as in
+    `DataFrame.eval`, they're treated as `&`, `|` and `~`.  Only applied
+    to top level statements, so functions defined in the code keep normal
+    Python semantics."""
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        return ast.copy_location(
+            functools.reduce(lambda left, right: ast.BinOp(left, op, right), node.values), node
+        )
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(ast.UnaryOp(ast.Invert(), node.operand), node)
+        return node
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        # chained comparisons like `0 < x < 10` become `(0 < x) & (x < 10)`
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        operands = [node.left] + node.comparators
+        comparisons: list[ast.expr] = [
+            ast.Compare(left, [op], [right])
+            for left, op, right in zip(operands, node.ops, operands[1:])
+        ]
+        return ast.copy_location(
+            functools.reduce(lambda left, right: ast.BinOp(left, ast.BitAnd(), right), comparisons),
+            node,
+        )
+
+    def visit_Lambda(self, node: ast.Lambda) -> ast.AST:
+        return node
+
+
+def _bound_names(tree: ast.AST) -> set[str]:
+    """Every name which `tree` assigns, defines or imports, anywhere."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update((alias.asname or alias.name).split(".")[0] for alias in node.names)
+    return names
+
+
+class CompiledCode:
+    """A block of code, parsed and compiled once.  Columns are variables
+    holding pandas Series.  Top level assignments to names (other than names
+    starting with `_`) become columns, and top level expressions are filters:
+    rows are kept only where they are all true."""
+
+    def __init__(self, source: str):
+        tree = ast.parse(source, mode="exec")
+
+        self.columns: list[str] = []
+        self.filters: list[str] = []
+        body: list[ast.stmt] = []
+        for num, stmt in enumerate(tree.body):
+            if isinstance(stmt, ast.Expr):
+                name = f"{FILTER_PREFIX}{num}"
+                value = _ElementwiseLogic().visit(stmt.value)
+                stmt = ast.copy_location(ast.Assign([ast.Name(name, ast.Store())], value), stmt)
+                self.filters.append(name)
+            elif isinstance(stmt, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+                if isinstance(stmt, ast.AugAssign) and isinstance(stmt.target, ast.Name):
+                    # `x += 1` would change the column in place, which is
+                    # the input's data, so it's treated as `x = x + 1`.
+                    value = ast.BinOp(ast.Name(stmt.target.id, ast.Load()), stmt.op, stmt.value)
+                    stmt = ast.copy_location(
+                        ast.Assign([ast.Name(stmt.target.id, ast.Store())], value), stmt
+                    )
+                if stmt.value is not None:
+                    stmt.value = _ElementwiseLogic().visit(stmt.value)
+                targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+                for target in targets:
+                    for node in ast.walk(target):
+                        if (
+                            isinstance(node, ast.Name)
+                            and not node.id.startswith("_")
+                            and node.id not in self.columns
+                        ):
+                            self.columns.append(node.id)
+            body.append(stmt)
+
+        module = ast.fix_missing_locations(ast.Module(body=body, type_ignores=[]))
+        self.code = compile(module, "<code>", "exec")
+
+        self.bound_names = _bound_names(tree)
+        self.loaded_names = set(
+            node.id
+            for node in ast.walk(tree)
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)
+        )
+
+    def unknown_names(self, columns: Iterable[str]) -> set[str]:
+        """Names the code uses which aren't `columns` or otherwise defined"""
+        return (
+            self.loaded_names
+            - self.bound_names
+            - set(columns)
+            - set(CODE_GLOBALS)
+            - set(dir(builtins))
+        )
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        namespace = dict(CODE_GLOBALS)
+        if df.index.name is not None:
+            namespace[df.index.name] = df.index.to_series()
+        namespace.update((column, df[column]) for column in df.columns if isinstance(column, str))
+
+        exec(self.code, namespace)  # pylint: disable=exec-used
+
+        columns = dict((name, namespace[name]) for name in self.columns if name in namespace)
+        if columns:
+            df = df.assign(**columns)
 
+        mask = None
+        for name in self.filters:
+            mask = namespace[name] if mask is None else mask & namespace[name]
+        if mask is None:
+            return df
+        if np.ndim(mask) == 0:
+            return df if mask else df.iloc[0:0]
+        return df[np.asarray(mask, dtype=bool)]
+
+
+@functools.lru_cache(maxsize=100)
+def compile_code(source: str) -> CompiledCode:
+    return CompiledCode(source)
+
+
+def process(df: pd.DataFrame, sources: list[str]) -> pd.DataFrame:
+    for source in sources:
+        df = compile_code(source).apply(df)
     return df
 
 
 class EmbeddedPythonPlugin(DaskTransformPlugin):
+    """Runs blocks of Python code over each partition, in order.  Each block
+    is Python code where the columns are variables holding pandas Series.
+    `np`, `pd` and `math` are available, as is `unpack_sequences` for
+    sequences loaded with either "2-bit Packed" encoding.  Assigning to a
+    variable adds or replaces a column, and an expression by itself is a
+    filter, eg:
+
+        total = count_1 + count_2
+        total > 10 and score < 0.5
+
+    Code is compiled once and checked against the input columns when the
+    plugin is prepared.  New columns from a block are added all at once,
+    and filters are applied as boolean masks.
+
+    If "isolate" is set, the code runs in a separate process for each
+    partition, with optional limits on CPU time, memory and elapsed time.
+    A partition which exceeds a limit is reported and left empty, and the
+    rest of the partitions carry on."""
+
     name = "Embedded Python"
     title = "Embedded Python"
     description = "Embed Python code into CountESS"
     version = VERSION
 
-    parameters = {"code": ArrayParam("Code", TextParam("Code"))}
+    parameters = {
+        "code": ArrayParam("Code", TextParam("Code")),
+        "isolate": BooleanParam("Run in Separate Processes?", False),
+        "cpu_limit": IntegerParam("CPU Time Limit (seconds, 0 = none)", 0),
+        "memory_limit": IntegerParam("Memory Limit (MB, 0 = none)", 0),
+        "timeout": IntegerParam("Timeout (seconds, 0 = none)", 0),
+    }
 
-    def run_dask(self, df, logger: Logger) -> dd.DataFrame:
+    def code_sources(self) -> list[str]:
         assert isinstance(self.parameters["code"], ArrayParam)
-
-        codes = [
-            p.value.replace("\n", " ")
-            for p in self.parameters["code"]
-            if isinstance(p, TextParam) and p.value.strip()
+        return [
+            p.value for p in self.parameters["code"] if isinstance(p, TextParam) and p.value.strip()
         ]
 
+    def prepare_dask(self, data: dd.DataFrame | pd.DataFrame, logger: Logger):
+        super().prepare_dask(data, logger)
+
+        columns = set(data.columns)
+        if data.index.name is not None:
+            columns.add(data.index.name)
+
+        for num, source in enumerate(self.code_sources(), 1):
+            try:
+                compiled = compile_code(source)
+            except SyntaxError as exc:
+                logger.error(f"Syntax error in code {num}: {exc}")
+                return False
+            unknown_names = compiled.unknown_names(columns)
+            if unknown_names:
+                logger.warning(f"Unknown names in code {num}: {', '.join(sorted(unknown_names))}")
+            columns.update(compiled.columns)
+        return True
+
+    def run_dask(self, df, logger: Logger) -> dd.DataFrame:
+        sources = self.code_sources()
+        if self.parameters["isolate"].value:
+            return self.run_isolated(df, sources, logger)
+
+        if isinstance(df, dd.DataFrame):
+            return df.map_partitions(process, sources)
+        else:
+            return process(df, sources)
+
+    def run_isolated(self, df, sources: list[str], logger: Logger) -> dd.DataFrame:
+        limits = {
+            "cpu_limit": self.parameters["cpu_limit"].value or None,
+            "memory_limit": (self.parameters["memory_limit"].value * 1024 * 1024) or None,
+            "timeout": self.parameters["timeout"].value or None,
+        }
+        func = functools.partial(process, sources=sources)
+
+        # the output columns are found by running the code on a couple of
+        # rows of fake data, which is also done in a separate process.  The
+        # limits are meant for real partitions, so only the timeout applies.
+        # If even that's exceeded, the output columns aren't known until the
+        # partitions are computed.
+        input_meta = df._meta_nonempty if isinstance(df, dd.DataFrame) else meta_nonempty(df)
+        try:
+            meta = run_isolated(func, input_meta, timeout=limits["timeout"]).iloc[0:0]
+            enforce_metadata = True
+        except ResourceLimitError as exc:
+            logger.warning(f"Finding output columns {exc}: they may not be shown correctly")
+            meta = input_meta.iloc[0:0]
+            enforce_metadata = False
+
+        def process_partition(partition: pd.DataFrame, partition_info: Optional[dict] = None):
+            number = partition_info["number"] if partition_info else 0
+            try:
+                return run_isolated(func, partition, **limits)
+            except ResourceLimitError as exc:
+                logger.warning(f"Partition {number} {exc}: its output is empty")
+                return meta
+
         if isinstance(df, dd.DataFrame):
-            return df.map_partitions(process, codes)
+            return df.map_partitions(
+                process_partition, meta=meta, enforce_metadata=enforce_metadata
+            )
         else:
-            return process(df, codes)
+            return process_partition(df)
@@ -1,56 +1,275 @@
-from collections.abc import Iterable, Mapping
-from itertools import islice
-from typing import Generator, Optional
+import os
+import re
+from collections import Counter
+from itertools import compress, islice, zip_longest
+from typing import BinaryIO, Iterator, Optional
 
-import dask.dataframe as dd
 import numpy as np
 import pandas as pd  # type: ignore
-from fqfa.fastq.fastq import parse_fastq_reads  # type: ignore
-from more_itertools import ichunked
 
 from countess import VERSION
-from countess.core.parameters import (ArrayParam, BooleanParam, FileArrayParam,
-                                      FileParam, FloatParam, MultiParam,
-                                      StringParam)
+from countess.core.logger import Logger
+from countess.core.parameters import BooleanParam, ChoiceParam, FloatParam, IntegerParam
 from countess.core.plugins import DaskInputPlugin
-from countess.utils.dask import concat_dataframes, merge_dataframes
+from countess.utils.compression import open_compressed
+from countess.utils.dask import concat_dataframes
+from countess.utils.sequence import MAX_PACKED_LENGTH, pack_sequences, pack_sequences_bytes
+
+# Number of reads parsed at once.
+CHUNK_SIZE = 100000
+
+# FASTQ quality scores are stored as Phred+33.
+QUALITY_OFFSET = 33
+
+COMPLEMENT = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+
+# Illumina-style read numbers in filenames, eg: "sample_S1_L001_R1_001.fastq.gz"
+READ_1_FILENAME_RE = re.compile(r"_R1(?=[._])")
+READ_NUMBER_FILENAME_RE = re.compile(r"_R[12](?=[._])")
+
+PAIR_CONCATENATE = "Concatenate"
+PAIR_OVERLAP = "Overlap"
+
+ENCODING_STRING = "String"
+ENCODING_CATEGORICAL = "Categorical"
+ENCODING_ARROW = "Arrow String"
+ENCODING_PACKED = "2-bit Packed"
+ENCODING_PACKED_BYTES = "2-bit Packed Bytes"
+
+
+def fastq_chunks(
+    fh: BinaryIO, chunk_size: int = CHUNK_SIZE, row_limit: Optional[int] = None
+) -> Iterator[tuple[list[bytes], list[bytes]]]:
+    """Reads a FASTQ file opened in binary mode, yielding `(sequences, qualities)`
+    lists of up to `chunk_size` reads at a time, until `row_limit` reads have been read."""
+    while row_limit is None or row_limit > 0:
+        num_reads = chunk_size if row_limit is None else min(chunk_size, row_limit)
+        lines = list(islice(fh, num_reads * 4))
+        if not lines:
+            return
+        if len(lines) % 4 or any(not header.startswith(b"@") for header in lines[0::4]):
+            raise ValueError("incomplete FASTQ record")
+        if row_limit is not None:
+            row_limit -= len(lines) // 4
+        yield [s.rstrip() for s in lines[1::4]], [q.rstrip() for q in lines[3::4]]
+
+
+def average_quality(qualities: list[bytes]) -> np.ndarray:
+    """Returns the mean quality score of each read in `qualities`, calculated for
+    the whole chunk at once from a cumulative sum of the raw quality bytes."""
+    lengths = np.fromiter((len(q) for q in qualities), dtype=np.int64, count=len(qualities))
+    scores = np.frombuffer(b"".join(qualities), dtype=np.uint8).astype(np.int64) - QUALITY_OFFSET
+    cumulative_scores = np.concatenate(([0], np.cumsum(scores)))
+    ends = np.cumsum(lengths)
+    return (cumulative_scores[ends] - cumulative_scores[ends - lengths]) / np.maximum(lengths, 1)
+
+
+def _last_match(regex: re.Pattern, string: str) -> Optional[re.Match]:
+    match = None
+    for match in regex.finditer(string):
+        pass
+    return match
+
+
+def read_2_filename(filename: str) -> Optional[str]:
+    """Works out the name of the read 2 file which goes with read 1 file
+    `filename`, by replacing the last "_R1" in its basename with "_R2".
+    Returns None if there's no "_R1" to replace."""
+    dirname, basename = os.path.split(filename)
+    match = _last_match(READ_1_FILENAME_RE, basename)
+    if match is None:
+        return None
+    return os.path.join(dirname, basename[: match.start()] + "_R2" + basename[match.end() :])
+
+
+def is_read_2_filename(filename: str) -> bool:
+    """A file is a read 2 file if the last read number in its basename is _R2"""
+    match = _last_match(READ_NUMBER_FILENAME_RE, os.path.basename(filename))
+    return match is not None and match.group() == "_R2"
+
+
+def reverse_complement(sequence: bytes) -> bytes:
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def merge_overlapping_pair(sequence1: bytes, sequence2: bytes, min_overlap: int) -> Optional[bytes]:
+    """Merges read 1 with the reverse complement of read 2, if the end of read 1
+    exactly matches the start of the reverse complemented read 2 for at least
+    `min_overlap` bases.  The longest such overlap is used.  Returns None if
+    the reads don't overlap."""
+    reversed2 = reverse_complement(sequence2)
+    seed = reversed2[:min_overlap]
+    position = sequence1.find(seed)
+    while position >= 0:
+        if reversed2.startswith(sequence1[position:]):
+            return sequence1[:position] + reversed2
+        position = sequence1.find(seed, position + 1)
+    return None
 
 
 class LoadFastqPlugin(DaskInputPlugin):
-    """Load counts from one or more FASTQ files, by first building a dask dataframe of raw sequences
-    with count=1 and then grouping by sequence and summing counts.  It supports counting
-    in multiple columns."""
+    """Load counts from one or more FASTQ files.  Each file is read in chunks and
+    the sequences which pass the quality filter are counted as they are read, so
+    memory use depends on the number of distinct sequences rather than the
+    number of reads.  Counts from multiple files are then summed by sequence.
+    Parsing is CPU bound, so multiple files are read in parallel processes.
+
+    In paired-end mode, each read 1 file (`*_R1*`) is read in lockstep with the
+    matching read 2 file (`*_R2*`), both reads have to pass the quality filter,
+    and each pair is counted as the concatenation of the two reads or as the
+    two reads merged where they overlap.  Read 2 files in the file list are
+    skipped, as they are read along with their read 1 file.
+
+    The `sequence` column can be stored more compactly than Python strings:
+    as a categorical, as Arrow strings (needs `pyarrow`) or packed 2 bits per
+    base (see `countess.utils.sequence`).  "2-bit Packed" packs each sequence
+    into a uint64, which is much faster to group and join on but only works
+    for barcode-length reads: ACGT sequences of up to 31 bases.  "2-bit Packed
+    Bytes" packs reads of any length into bytes, and keeps reads with Ns (or
+    other bases) as they are.  Packed sequences can be turned back into
+    strings with `unpack_sequences` in the Embedded Python plugin, eg:
+    `sequence = unpack_sequences(sequence)`."""
 
     name = "FASTQ Load"
     title = "Load from FastQ"
     description = "Loads counts from FASTQ files containing either variant or barcodes"
     version = VERSION
 
-    file_types = [("FASTQ", "*.fastq"), ("FASTQ (gzipped)", "*.fastq.gz")]
+    file_types = [
+        ("FASTQ", "*.fastq"),
+        ("FASTQ (gzipped)", "*.fastq.gz"),
+        ("FASTQ (bgzipped)", "*.fastq.bgz"),
+        ("FASTQ (zstd)", "*.fastq.zst"),
+    ]
+
+    max_processes = None
 
     parameters = {
         "group": BooleanParam("Group by Sequence?", True),
         "min_avg_quality": FloatParam("Minimum Average Quality", 10),
+        "paired": BooleanParam("Paired-end Reads?", False),
+        "pair_merge": ChoiceParam(
+            "Paired-end Merging", PAIR_CONCATENATE, choices=[PAIR_CONCATENATE, PAIR_OVERLAP]
+        ),
+        "min_overlap": IntegerParam("Minimum Paired-end Overlap", 10),
+        "sequence_encoding": ChoiceParam(
+            "Sequence Encoding",
+            ENCODING_STRING,
+            choices=[
+                ENCODING_STRING,
+                ENCODING_CATEGORICAL,
+                ENCODING_ARROW,
+                ENCODING_PACKED,
+                ENCODING_PACKED_BYTES,
+            ],
+        ),
     }
 
-    def read_file_to_dataframe(self, file_param, column_suffix="", row_limit=None):
-        records = []
-        count_column_name = "count"
-        if column_suffix:
-            count_column_name += "_" + column_suffix
+    def _read_single_end(self, filename: str, row_limit: Optional[int]) -> Iterator[list[bytes]]:
+        """Yields lists of the sequences which pass the quality filter"""
+        min_avg_quality = self.parameters["min_avg_quality"].value
+
+        with open_compressed(filename) as fh:
+            for sequences, qualities in fastq_chunks(fh, row_limit=row_limit):
+                mask = average_quality(qualities) >= min_avg_quality
+                yield list(compress(sequences, mask))
+
+    def _read_paired_end(
+        self, filename: str, logger: Logger, row_limit: Optional[int]
+    ) -> Iterator[list[bytes]]:
+        """Yields lists of the merged sequences of read pairs which both pass the
+        quality filter"""
+        min_avg_quality = self.parameters["min_avg_quality"].value
+        pair_merge = self.parameters["pair_merge"].value
+        min_overlap = max(self.parameters["min_overlap"].value, 1)
+
+        filename2 = read_2_filename(filename)
+        if filename2 is None:
+            raise ValueError(f"Can't find the read 2 file for {filename}: expecting '_R1' in name")
+
+        num_unmerged = 0
+        with open_compressed(filename) as fh1, open_compressed(filename2) as fh2:
+            for chunk1, chunk2 in zip_longest(
+                fastq_chunks(fh1, row_limit=row_limit), fastq_chunks(fh2, row_limit=row_limit)
+            ):
+                if chunk1 is None or chunk2 is None or len(chunk1[0]) != len(chunk2[0]):
+                    raise ValueError(f"{filename} and {filename2} have different numbers of reads")
+
+                mask = (average_quality(chunk1[1]) >= min_avg_quality) & (
+                    average_quality(chunk2[1]) >= min_avg_quality
+                )
+                pairs = compress(zip(chunk1[0], chunk2[0]), mask)
+
+                if pair_merge == PAIR_OVERLAP:
+                    merged = [merge_overlapping_pair(s1, s2, min_overlap) for s1, s2 in pairs]
+                    sequences = [s for s in merged if s is not None]
+                    num_unmerged += len(merged) - len(sequences)
+                    yield sequences
+                else:
+                    yield [s1 + s2 for s1, s2 in pairs]
+
+        if num_unmerged:
+            logger.warning(f"{num_unmerged} read pairs in {filename} didn't overlap")
+
+    def read_file_to_dataframe(self, file_param, logger, row_limit=None):
+        filename = file_param["filename"].value
+        group = self.parameters["group"].value
+
+        counter: Counter[bytes] = Counter()
+        sequences: list[bytes] = []
+
+        if not self.parameters["paired"].value:
+            chunks = self._read_single_end(filename, row_limit)
+        elif is_read_2_filename(filename):
+            chunks = iter([])
+        else:
+            chunks = self._read_paired_end(filename, logger, row_limit)
+
+        for chunk_sequences in chunks:
+            if group:
+                counter.update(chunk_sequences)
+            else:
+                sequences.extend(chunk_sequences)
+
+        if group:
+            counts = np.fromiter(counter.values(), dtype=np.int64, count=len(counter))
+            return self._make_dataframe(list(counter.keys()), counts)
+        else:
+            counts = np.ones(len(sequences), dtype=np.int64)
+            return self._make_dataframe(sequences, counts)
+
+    def _make_dataframe(self, sequences: list[bytes], counts: np.ndarray) -> pd.DataFrame:
+        encoding = self.parameters["sequence_encoding"].value
+
+        if encoding == ENCODING_PACKED:
+            packed, valid = pack_sequences(sequences)
+            if not valid.all():
+                # dropping these would silently lose counts
+                raise ValueError(
+                    f"{counts[~valid].sum()} reads can't be packed: only ACGT sequences of up to "
+                    f"{MAX_PACKED_LENGTH} bases can be packed, choose another Sequence Encoding "
+                    f"(eg: {ENCODING_PACKED_BYTES})"
+                )
+            return pd.DataFrame({"sequence": packed, "count": counts})
+        elif encoding == ENCODING_PACKED_BYTES:
+            column = pd.Series(pack_sequences_bytes(sequences), dtype=object)
+            return pd.DataFrame({"sequence": column, "count": counts})
 
-        with open(file_param["filename"].value, "r") as fh:
-            for fastq_read in islice(parse_fastq_reads(fh), 0, row_limit):
-                if fastq_read.average_quality() >= self.parameters["min_avg_quality"].value:
-                    records.append((fastq_read.sequence, 1))
-        return pd.DataFrame.from_records(records, columns=("sequence", count_column_name))
+        strings = [s.decode("ascii") for s in sequences]
+        if encoding == ENCODING_CATEGORICAL:
+            column = pd.Categorical(strings)
+        elif encoding == ENCODING_ARROW:
+            column = pd.array(strings, dtype="string[pyarrow]")
+        else:
+            column = strings
+        return pd.DataFrame({"sequence": column, "count": counts})
 
     def combine_dfs(self, dfs):
         """first concatenate the count dataframes, then (optionally) group them by sequence"""
 
-        combined_df = concat_dask_dataframes(dfs)
+        combined_df = concat_dataframes(dfs)
 
-        if len(combined_df) and self.parameters["group"].value:
-            combined_df = combined_df.groupby(by=["sequence"]).sum()
+        if "sequence" in combined_df.columns and self.parameters["group"].value:
+            combined_df = combined_df.groupby(by=["sequence"], observed=True).sum()
 
         return combined_df
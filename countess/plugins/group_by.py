@@ -1,44 +1,123 @@
-from collections.abc import Iterable, Mapping
-from typing import Generator, Optional
+from collections import defaultdict
+from collections.abc import Callable
 
 import dask.dataframe as dd
 import numpy as np
+import pandas as pd  # type: ignore
 
-from countess.core.parameters import ChoiceParam
+from countess.core.parameters import (ArrayParam, ChoiceParam,
+                                      ColumnChoiceParam,
+                                      ColumnOrIndexChoiceParam, MultiParam)
 from countess.core.plugins import DaskTransformPlugin
 
 VERSION = "0.0.1"
 
+NONE_OPERATION = "— NONE —"
 
-class GroupByPlugin(DaskTransformPlugin):
-    """Groups a Dask Dataframe by an arbitrary column and rolls up rows"""
 
-    # XXX should support an operation per column, using
-    # dd.Aggregation to supply appropriate chunk/agg/finalize
-    # functions which (potentially) work differently per column,
-    # as opposed to the built-in aggregations which are the
-    # same for every column.
+def _sum_of_logs(series: pd.Series) -> float:
+    return np.log(series).sum()
+
+
+# Each aggregation has a version for Dask and an equivalent for pandas.
+# Dask and pandas both understand the names of their built-in aggregations,
+# others are defined as a dd.Aggregation, which Dask uses to aggregate each
+# group within each partition (`chunk`), then combine those results (`agg`)
+# and calculate the final value (`finalize`), all in the same tree reduction
+# as the other aggregations.
+AGGREGATIONS: dict[str, tuple[str | dd.Aggregation, str | Callable]] = dict(
+    (name, (name, name))
+    for name in ["sum", "size", "count", "mean", "std", "var", "sem", "min", "max", "first", "last"]
+)
+
+AGGREGATIONS["range"] = (
+    dd.Aggregation(
+        "range",
+        chunk=lambda s: (s.max(), s.min()),
+        agg=lambda maxs, mins: (maxs.max(), mins.min()),
+        finalize=lambda maxs, mins: maxs - mins,
+    ),
+    lambda s: s.max() - s.min(),
+)
+
+AGGREGATIONS["geometric mean"] = (
+    dd.Aggregation(
+        "geometric mean",
+        chunk=lambda s: (s.agg(_sum_of_logs), s.count()),
+        agg=lambda logs, counts: (logs.sum(), counts.sum()),
+        finalize=lambda logs, counts: np.exp(logs / counts),
+    ),
+    lambda s: np.exp(np.log(s).mean()),
+)
+
+
+class GroupByPlugin(DaskTransformPlugin):
+    """Groups a Dask Dataframe by one or more columns (or the index) and rolls
+    up rows, with a separate aggregation (or aggregations) for each column.
+    Columns without their own aggregations get the default operation.  All
+    the aggregations are calculated in a single pass."""
 
     name = "Group By"
-    title = "Groups records by a column"
-    description = "Group records by a column"
+    title = "Groups records by columns"
+    description = "Group records by columns"
     version = VERSION
 
     parameters = {
-        "column": ChoiceParam("Group By", "Index", choices=[]),
+        "columns": ArrayParam("Group By", ColumnOrIndexChoiceParam("Column")),
+        "aggregations": ArrayParam(
+            "Aggregations",
+            MultiParam(
+                "Aggregation",
+                {
+                    "column": ColumnChoiceParam("Column"),
+                    "operation": ChoiceParam("Operation", "sum", choices=AGGREGATIONS.keys()),
+                },
+            ),
+        ),
         "operation": ChoiceParam(
-            "Operation",
+            "Default Operation",
             "sum",
-            choices=["sum", "size", "std", "var", "sem", "min", "max"],
+            choices=[NONE_OPERATION] + list(AGGREGATIONS.keys()),
         ),
     }
 
-    def update(self):
-        self.parameters["column"].choices = ["Index"] + self.input_columns
-
     def run_dask(self, ddf: dd.DataFrame, logger) -> dd.DataFrame:
-        col_name = self.parameters["column"].value
-        col = ddf.index if col_name == "Index" else ddf[col_name]
-        oper = self.parameters["operation"].value
+        assert isinstance(self.parameters["columns"], ArrayParam)
+        assert isinstance(self.parameters["aggregations"], ArrayParam)
+
+        # the index can't be grouped by along with columns, so it gets
+        # turned into a column.
+        keys = [p.value for p in self.parameters["columns"] if p.value]
+        if not keys or any(p.is_index() for p in self.parameters["columns"]):
+            index_name = ddf.index.name or "index"
+            ddf = ddf.reset_index()
+            keys = [index_name if k == ColumnOrIndexChoiceParam.INDEX_VALUE else k for k in keys]
+            keys = keys or [index_name]
+
+        operations: dict[str, list[str]] = defaultdict(list)
+        for p in self.parameters["aggregations"]:
+            if p["column"].value and p["operation"].value:
+                operations[p["column"].value].append(p["operation"].value)
+
+        default_operation = self.parameters["operation"].value
+        if default_operation and default_operation != NONE_OPERATION:
+            for column in ddf.columns:
+                if column not in keys and column not in operations:
+                    operations[column].append(default_operation)
+
+        if not operations:
+            return ddf[keys].drop_duplicates().set_index(keys)
+
+        which = 0 if isinstance(ddf, dd.DataFrame) else 1
+        spec = dict(
+            (column, [AGGREGATIONS[op][which] for op in ops]) for column, ops in operations.items()
+        )
+        result = ddf.groupby(keys, observed=True).agg(spec)
 
-        return ddf.groupby(col).agg(oper)
+        # columns with more than one aggregation get the operation as a suffix
+        result.columns = [
+            column if len(ops) == 1 else f"{column}__{op}"
+            for column, ops in operations.items()
+            for op in ops
+        ]
+        return result
@@ -1,75 +1,218 @@
-from collections import defaultdict
-from typing import Mapping, Optional
+import functools
+import os
+from collections.abc import Mapping
+from typing import Any, Optional
 
+import dask
 import dask.dataframe as dd
 import pandas as pd  # type: ignore
+from dask.utils import SerializableLock
 
 from countess import VERSION
-from countess.core.parameters import (BaseParam, ChoiceParam, FileArrayParam,
-                                      FileParam, MultiParam, StringParam)
+from countess.core.logger import Logger
+from countess.core.parameters import (ArrayParam, BooleanParam, ChoiceParam,
+                                      FileSaveParam, IntegerParam, MultiParam,
+                                      StringParam)
 from countess.core.plugins import DaskBasePlugin, DaskInputPlugin
-from countess.utils.dask import empty_dask_dataframe
+from countess.utils.dask import concat_dataframes, empty_dask_dataframe
+
+# The HDF5 library isn't thread safe, so partitions are read one at a time.
+HDF_LOCK = SerializableLock()
+
+
+@functools.lru_cache(maxsize=100)
+def _hdf_keys(filename: str, mtime_ns: int, size: int) -> list[str]:
+    with pd.HDFStore(filename, mode="r") as hs:
+        return sorted(hs.keys())
+
+
+def hdf_keys(filename: str) -> list[str]:
+    """Lists the keys in an HDF5 file.  Opening a big store to list its keys
+    is slow, so listings are cached until the file is modified."""
+    stat = os.stat(filename)
+    return _hdf_keys(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+def _read_hdf_partition(filename: str, key: str, start: int, stop: int, options: dict):
+    with HDF_LOCK:
+        return pd.read_hdf(filename, key, mode="r", start=start, stop=stop, **options)
 
 
 class LoadHdfPlugin(DaskInputPlugin):
+    """Load HDF5 files.  Keys in table format are read lazily, a chunk of rows
+    per Dask partition, and the `where` condition (using PyTables query
+    syntax, eg: `count > 10`) and column selection are applied by PyTables
+    as each chunk is read.  Conditions can only use indexed and
+    `data_columns` columns, which includes all columns written by
+    StoreHdfPlugin.  Keys in fixed format have to be read whole."""
+
     name = "HDF5 Load"
     title = "Load from HDF5"
     description = "Loads counts from HDF5 files"
     version = VERSION
 
-    file_types = [("HDF5 File", "*.hdf5")]
+    file_types = [("HDF5 File", "*.hdf5"), ("HDF5 File", "*.h5")]
     file_params = {
         "key": ChoiceParam("HDF Key"),
     }
 
-    keys: list[str] = []
+    parameters = {
+        "columns": ArrayParam("Columns", StringParam("Column Name", "")),
+        "where": StringParam("Where", ""),
+        "chunk_size": IntegerParam("Rows per Partition", 1000000),
+    }
 
     def update(self):
-        super().update()
-
+        assert isinstance(self.parameters["files"], ArrayParam)
         for fp in self.parameters["files"]:
             try:
-                with pd.HDFStore(fp.filename.value) as hs:
-                    fp.key.choices = sorted(hs.keys())
-            except IOError as e:
-                # XXX
+                fp["key"].set_choices(hdf_keys(fp["filename"].value))
+            except (IOError, ValueError):
                 pass
 
     def read_file_to_dataframe(
-        self, fp: MultiParam, logger, row_limit: Optional[int] = None
-    ) -> pd.DataFrame:
-        if not fp.key.value or fp.key.value not in fp.key.choices:
-            with pd.HDFStore(fp.filename.value) as hs:
-                fp.key.choices = sorted(hs.keys())
-            fp.key.value = fp.key.choices[0] if len(fp.key.choices) == 1 else None
-            return empty_dask_dataframe()
-
+        self, fp: MultiParam, logger: Logger, row_limit: Optional[int] = None
+    ) -> pd.DataFrame | dd.DataFrame:
+        assert isinstance(self.parameters["columns"], ArrayParam)
         filename = fp["filename"].value
+        fp["key"].set_choices(hdf_keys(filename))
         key = fp["key"].value
+        if not key:
+            return empty_dask_dataframe()
 
-        with pd.HDFStore(filename) as hs:
-            df = hs.select(key, start=0, stop=row_limit)
-
-        return df
+        options: dict[str, Any] = {}
+        columns = [p.value for p in self.parameters["columns"] if p.value]
+        if columns:
+            options["columns"] = columns
+        where = self.parameters["where"].value
+        if where:
+            options["where"] = where
+
+        with HDF_LOCK, pd.HDFStore(filename, mode="r") as hs:
+            storer = hs.get_storer(key)
+            if not storer.is_table:
+                if where:
+                    logger.warning(f"Can't apply 'where' to {filename} {key}: not table format")
+                # fixed format can't select columns as it reads, so they're
+                # selected afterwards.
+                df = hs.select(key, stop=row_limit)
+                return df[columns] if columns else df
+            if row_limit is not None:
+                return self._select_rows(hs, key, options, row_limit)
+            nrows = storer.nrows
+            meta = hs.select(key, start=0, stop=0, **options)
+
+        chunk_size = max(self.parameters["chunk_size"].value, 1)
+        partitions = [
+            dask.delayed(_read_hdf_partition)(filename, key, start, start + chunk_size, options)
+            for start in range(0, nrows, chunk_size)
+        ]
+        if not partitions:
+            return meta
+        return dd.from_delayed(partitions, meta=meta)
+
+    def _select_rows(self, hs: pd.HDFStore, key: str, options: dict, row_limit: int):
+        """Reads chunks until `row_limit` rows have matched the `where`
+        condition, so previews aren't empty just because the first few rows
+        don't match."""
+        chunk_size = max(self.parameters["chunk_size"].value, row_limit, 1)
+        dfs = []
+        num_rows = 0
+        for df in hs.select(key, chunksize=chunk_size, **options):
+            dfs.append(df)
+            num_rows += len(df)
+            if num_rows >= row_limit:
+                break
+        if not dfs:
+            return hs.select(key, start=0, stop=0, **options)
+        return pd.concat(dfs).head(row_limit)
+
+
+def _string_sizes(df: pd.DataFrame | dd.DataFrame, min_size: int) -> dict[str, int]:
+    """PyTables stores strings at a fixed size per column, which is set when
+    the key is created, so string columns (and the index) are given room
+    for `min_size` characters, or the longest string in `df` if that's
+    known and longer.  The lengths of strings in Dask DataFrames aren't
+    known until they're written."""
+    sizes = {}
+    columns = [("index", df.index)] + [(str(name), df[name]) for name in df.columns]
+    for name, values in columns:
+        if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+            size = min_size
+            if isinstance(df, pd.DataFrame) and len(values):
+                size = max(size, int(values.astype(str).str.len().max()))
+            sizes[name] = size
+    return sizes
 
 
 class StoreHdfPlugin(DaskBasePlugin):
+    """Saves to a key in an HDF5 file, in table format with every column as
+    a data column so that LoadHdfPlugin can filter on any of them.  Either
+    replaces the key or appends to it, and other keys in the file are kept.
+    Dask partitions are written in order, one at a time.
+
+    String columns can't hold strings longer than they were created for, so
+    they're created with room for at least "Minimum String Length"
+    characters.  Appending longer strings to an existing key fails."""
+
     name = "HDF Writer"
     title = "HDF Writer"
     description = "Write to HDF5"
+    version = VERSION
 
-    params = {
-        "pattern": {
-            "label": "Filename Pattern",
-            "type": str,
-            "text": "Filename pattern",
-        },
-        "key": {"label": "HDF key", "type": str, "text": "hdf key"},
-    }
+    file_types = [("HDF5 File", "*.hdf5"), ("HDF5 File", "*.h5")]
 
-    def __init__(self, params, file_params):
-        self.pattern = params["pattern"]
-        self.key = params["key"]
+    parameters = {
+        "filename": FileSaveParam("Filename", file_types=file_types),
+        "key": StringParam("HDF Key", "data"),
+        "append": BooleanParam("Append to Key?", False),
+        "string_size": IntegerParam("Minimum String Length", 255),
+    }
 
-    def run(self, ddf):
-        return ddf.to_hdf(self.pattern, self.key, "w")
+    def run(
+        self,
+        obj: Any,
+        logger: Logger,
+        row_limit: Optional[int] = None,
+    ):
+        filename = self.parameters["filename"].value
+        key = self.parameters["key"].value
+        if row_limit is not None or not filename or not key:
+            return None
+
+        # multiple inputs are written to the same key
+        if isinstance(obj, Mapping):
+            obj = concat_dataframes(list(obj.values()))
+
+        append = self.parameters["append"].value
+        options: dict[str, Any] = {
+            "mode": "a",
+            "format": "table",
+            "append": append,
+            "data_columns": True,
+        }
+        # string sizes are fixed once the key exists, so they're only set
+        # when it's created.
+        if not (
+            append and os.path.exists(filename) and "/" + key.lstrip("/") in hdf_keys(filename)
+        ):
+            options["min_itemsize"] = _string_sizes(obj, self.parameters["string_size"].value)
+
+        logger.progress("Writing", 0)
+        try:
+            if isinstance(obj, dd.DataFrame):
+                obj.to_hdf(filename, key, lock=HDF_LOCK, **options)
+            else:
+                obj.to_hdf(filename, key, **options)
+        except ValueError as exc:
+            if "min_itemsize" not in str(exc):
+                raise
+            logger.error(
+                f"Can't write to {filename} {key}: a string is too long for its column. "
+                "Increase Minimum String Length, or for an existing key, replace it.",
+                detail=str(exc),
+            )
+            return None
+        logger.progress("Done", 100)
+
+        return None
@@ -1,26 +1,82 @@
-import itertools
-from collections.abc import Callable, Iterable, Mapping, MutableMapping
-from typing import Generator, Optional
+from collections import Counter
+from typing import Optional, Sequence
 
 import dask.dataframe as dd
-import numpy as np
 import pandas as pd  # type: ignore
+from dask.dataframe.multi import align_partitions
 
 from countess import VERSION
 from countess.core.logger import Logger
-from countess.core.parameters import (ArrayParam, BooleanParam, ChoiceParam,
-                                      MultiParam, StringParam)
-from countess.core.plugins import DaskBasePlugin, DaskProgressCallback
+from countess.core.parameters import ArrayParam, BooleanParam, ChoiceParam, MultiParam, StringParam
+from countess.core.plugins import DaskBasePlugin
+from countess.utils.dask import dataframe_memory_usage
 
 INDEX = "— INDEX —"
 
+# pandas inputs which take up less memory than this are joined by copying
+# them to every partition of the other inputs, instead of partitioning them.
+BROADCAST_MAX_BYTES = 256 * 1024 * 1024
+
+# Bigger pandas inputs are split into partitions of this many rows.
+PARTITION_ROWS = 1000000
+
+
+def is_small_dataframe(df: pd.DataFrame | dd.DataFrame) -> bool:
+    """pandas DataFrames are small if they fit in BROADCAST_MAX_BYTES.  The
+    size of a Dask DataFrame isn't known without computing it, so they're
+    never assumed to be small."""
+    return isinstance(df, pd.DataFrame) and dataframe_memory_usage(df) <= BROADCAST_MAX_BYTES
+
+
+def join_frames(dfs: Sequence[pd.DataFrame], required: Sequence[bool]) -> pd.DataFrame:
+    """Joins pandas DataFrames on their indexes.  A key is kept if it is in
+    every input which is `required`, or in any input if none of them are."""
+    result = dfs[0]
+    result_required = required[0]
+    for df, df_required in zip(dfs[1:], required[1:]):
+        if result_required:
+            how = "inner" if df_required else "left"
+        else:
+            how = "right" if df_required else "outer"
+        result = result.merge(df, how=how, left_index=True, right_index=True)
+        result_required = result_required or df_required
+    return result
+
+
+def index_dataframe(ddf: dd.DataFrame, join_on: Optional[str]) -> dd.DataFrame:
+    """Sets the index of `ddf` to column `join_on`, or sorts it by its
+    existing index if `join_on` is None, so that it has known divisions."""
+    if join_on is not None:
+        return ddf.set_index(join_on)
+    if ddf.known_divisions:
+        return ddf
+    # Dask DataFrames don't have rename_axis() so it's done per partition.
+    index_name = ddf.index.name
+    ddf = ddf.map_partitions(pd.DataFrame.rename_axis, "__index")
+    return (
+        ddf.reset_index().set_index("__index").map_partitions(pd.DataFrame.rename_axis, index_name)
+    )
+
 
 class DaskJoinPlugin(DaskBasePlugin):
-    """Groups a Dask Dataframe by an arbitrary column and rolls up rows"""
+    """Joins any number of Dask or pandas DataFrames on a column or index of
+    each, in a single operation:
+    * If all the inputs are pandas DataFrames they're joined in memory.
+    * Small pandas inputs, and Dask inputs in a single partition, are
+      broadcast: joined with every partition of the Dask inputs, as long as
+      a Dask input is required so that keys which are only in the small
+      input don't need to be kept.
+    * Dask inputs (and other pandas inputs) are indexed on their join key,
+      which sorts them unless they're already indexed by it, and then their
+      partitions are aligned so that each partition of the result is made
+      by joining matching partitions of every input.  If there's only one
+      Dask input it doesn't need to be sorted.
+    Columns with the same name in more than one input get the source name
+    of their input as a suffix."""
 
     name = "Join"
     title = "Join"
-    description = "..."
+    description = "Joins multiple inputs on an index or column"
     version = VERSION
 
     parameters = {
@@ -36,20 +92,25 @@ class DaskJoinPlugin(DaskBasePlugin):
             ),
             read_only=True,
             min_size=2,
-            max_size=2,
         )
     }
 
     def prepare(self, data, logger: Logger):
-        data_items = list(data.items())
         inputs_param = self.parameters["inputs"]
         assert isinstance(inputs_param, ArrayParam)
 
-        if len(data_items) != 2 or len(inputs_param) != 2:
-            raise NotImplementedError("Only two-way joins supported right now")
-        if not all((isinstance(df, (dd.DataFrame, pd.DataFrame)) for _, df in data_items)):
+        if len(data) < 2:
+            raise ValueError("Join needs at least two inputs")
+        if not all((isinstance(df, (dd.DataFrame, pd.DataFrame)) for df in data.values())):
             raise NotImplementedError("Feed me dataframes")
 
+        # keep the settings of inputs which are still connected
+        old_params = dict((p["source"].value, p) for p in inputs_param)
+        inputs_param.params = [
+            old_params.get(source_name) or inputs_param.param.copy() for source_name in data
+        ]
+        inputs_param.relabel()
+
         for input_param, (source_name, source_ddf) in zip(inputs_param, data.items()):
             input_param["source"].value = source_name
             input_param["join_on"].choices = [INDEX] + list(source_ddf.columns)
@@ -62,29 +123,86 @@ class DaskJoinPlugin(DaskBasePlugin):
     ):
         inputs_param = self.parameters["inputs"]
         assert isinstance(inputs_param, ArrayParam)
-        ip1 = inputs_param[0]
-        ip2 = inputs_param[1]
-        if ip1["required"].value:
-            if ip2["required"].value:
-                join_how = "inner"
-            else:
-                join_how = "left"
-        else:
-            if ip2["required"].value:
-                join_how = "right"
-            else:
-                join_how = "outer"
-
-        join_params: MutableMapping[str, str | bool] = {
-            "how": join_how,
-        }
-        if ip1["join_on"].value == INDEX:
-            join_params["left_index"] = True
-        else:
-            join_params["left_on"] = ip1["join_on"].value
-        if ip2["join_on"].value == INDEX:
-            join_params["right_index"] = True
+
+        sources = [ip["source"].value for ip in inputs_param]
+        dfs = [data[source] for source in sources]
+        required = [ip["required"].value for ip in inputs_param]
+        join_ons = [
+            None if ip["join_on"].value in (INDEX, None) else ip["join_on"].value
+            for ip in inputs_param
+        ]
+
+        # columns in more than one input are distinguished by their source.
+        column_counts = Counter(c for df, join_on in zip(dfs, join_ons) for c in df.columns)
+        dfs = [
+            df.rename(
+                columns=dict(
+                    (c, f"{c}_{source}")
+                    for c in df.columns
+                    if column_counts[c] > 1 and c != join_on
+                )
+            )
+            for df, source, join_on in zip(dfs, sources, join_ons)
+        ]
+
+        if all(isinstance(df, pd.DataFrame) for df in dfs):
+            logger.info("Join plan: all inputs joined in memory")
+            return join_frames(
+                [df if jo is None else df.set_index(jo) for df, jo in zip(dfs, join_ons)],
+                required,
+            )
+
+        # Dask inputs in a single partition (eg: a small table loaded from
+        # a file) are computed once so that they can be broadcast like
+        # pandas inputs, instead of every input having to be sorted to align
+        # with them.  The Dask input with the most partitions stays as it is.
+        plan = []
+        dask_nums = [num for num, df in enumerate(dfs) if isinstance(df, dd.DataFrame)]
+        largest_num = max(dask_nums, key=lambda num: dfs[num].npartitions)
+        single_nums = [num for num in dask_nums if num != largest_num and dfs[num].npartitions == 1]
+        if any(required[num] for num in dask_nums if num not in single_nums):
+            for num in single_nums:
+                dfs[num] = dfs[num].compute()
+                plan.append(f"compute {sources[num]}")
+
+        # pandas inputs are broadcast if they're small, and if there's a
+        # required Dask input, otherwise they're converted to Dask.
+        dask_required = any(r for df, r in zip(dfs, required) if isinstance(df, dd.DataFrame))
+        for num, (df, source, join_on) in enumerate(zip(dfs, sources, join_ons)):
+            if isinstance(df, pd.DataFrame):
+                if join_on is not None:
+                    df = dfs[num] = df.set_index(join_on)
+                    join_ons[num] = None
+                if dask_required and is_small_dataframe(df):
+                    plan.append(f"broadcast {source}")
+                else:
+                    dfs[num] = dd.from_pandas(df, chunksize=PARTITION_ROWS)
+                    plan.append(f"partition {source}")
+
+        dask_positions = [num for num, df in enumerate(dfs) if isinstance(df, dd.DataFrame)]
+        if len(dask_positions) > 1:
+            for num in dask_positions:
+                if join_ons[num] is not None or not dfs[num].known_divisions:
+                    plan.append(f"sort {sources[num]} by {join_ons[num] or 'index'}")
+                dfs[num] = index_dataframe(dfs[num], join_ons[num])
+                join_ons[num] = None
+            ddfs, divisions, _ = align_partitions(*[dfs[num] for num in dask_positions])
+            plan.append(f"align {len(ddfs)} inputs into {len(divisions) - 1} partitions")
         else:
-            join_params["right_on"] = ip2["join_on"].value
+            ddfs = [dfs[dask_positions[0]]]
+
+        logger.info("Join plan: " + ", ".join(plan))
+
+        broadcast_dfs = dict(
+            (num, df) for num, df in enumerate(dfs) if isinstance(df, pd.DataFrame)
+        )
+
+        def join_partitions(*partitions):
+            frames = dict(broadcast_dfs)
+            for num, partition in zip(dask_positions, partitions):
+                join_on = join_ons[num]
+                frames[num] = partition if join_on is None else partition.set_index(join_on)
+            return join_frames([frames[num] for num in range(len(dfs))], required)
 
-        return data[ip1["source"].value].merge(data[ip2["source"].value], **join_params)
+        meta = join_partitions(*(ddf._meta for ddf in ddfs))
+        return dd.map_partitions(join_partitions, *ddfs, meta=meta, align_dataframes=False)
@@ -1,7 +1,3 @@
-from collections.abc import Iterable, Mapping
-from typing import Generator, Optional
-
-import dask.dataframe as dd
 import numpy as np
 
 from countess.core.plugins import DaskScoringPlugin
@@ -10,12 +6,16 @@ VERSION = "0.0.1"
 
 
 class LogScorePlugin(DaskScoringPlugin):
-    """Log Scorer"""
+    """Log Scorer: the slope of a least squares fit of the log of the counts
+    against their position.  For two counts this is `log(count_1/count_0)`,
+    for more it's the rate of change across timepoints."""
 
     name = "Log Scorer"
     title = "Log Scores from Counts"
     description = "calculates log score from counts"
     version = VERSION
 
-    def score(self, cols):
-        return np.log(cols[1] / cols[0])
+    def score_matrix(self, counts: np.ndarray) -> np.ndarray:
+        times = np.arange(counts.shape[1], dtype=float)
+        times -= times.mean()
+        return (np.log(counts) @ times) / (times @ times)
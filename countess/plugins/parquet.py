@@ -0,0 +1,207 @@
+import operator
+from collections.abc import Mapping
+from typing import Any, Callable, Optional
+
+import dask.dataframe as dd
+import pandas as pd  # type: ignore
+
+from countess import VERSION
+from countess.core.logger import Logger
+from countess.core.parameters import (ArrayParam, BooleanParam, ChoiceParam,
+                                      ColumnChoiceParam, FileSaveParam,
+                                      MultiParam, StringParam)
+from countess.core.plugins import (DaskInputPlugin, DaskProgressCallback,
+                                   DaskTransformPlugin)
+from countess.utils.dask import concat_dataframes
+from countess.utils.files import write_in_place
+
+COMPARISON_OPERATORS: dict[str, Callable] = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+FILTER_OPERATORS = list(COMPARISON_OPERATORS.keys()) + ["in", "not in"]
+
+
+def _import_pyarrow():
+    try:
+        # pylint: disable=import-outside-toplevel
+        import pyarrow  # type: ignore
+        import pyarrow.dataset  # type: ignore
+        import pyarrow.fs  # type: ignore
+    except ImportError as exc:
+        raise ImportError("Parquet files need the 'pyarrow' package") from exc
+    return pyarrow
+
+
+def filter_expression(pa, schema, column: str, op: str, value: str):
+    """Builds a pyarrow dataset expression comparing `column` with `value`,
+    converted from a string to the type of the column in `schema`.  For
+    "in" and "not in", `value` is a comma separated list of values.
+    Filtering with an expression lets the reader skip whole row groups
+    using the statistics stored in the file."""
+    field = pa.dataset.field(column)
+    column_type = schema.field(column).type
+    if op in ("in", "not in"):
+        values = pa.array([v.strip() for v in value.split(",")]).cast(column_type)
+        expression = field.isin(values)
+        return ~expression if op == "not in" else expression
+    return COMPARISON_OPERATORS[op](field, pa.scalar(value).cast(column_type))
+
+
+def pandas_index_columns(schema) -> list[str]:
+    """Returns the names of the columns which pandas stored its index in"""
+    pandas_metadata = schema.pandas_metadata or {}
+    return [c for c in pandas_metadata.get("index_columns", []) if isinstance(c, str)]
+
+
+class LoadParquetPlugin(DaskInputPlugin):
+    """Load Parquet files, or directories of Parquet files partitioned by
+    column values (as written by SaveParquetPlugin).  Only the selected
+    columns are read, and filters are applied by the reader so row groups
+    which can't match aren't read at all."""
+
+    name = "Parquet Load"
+    title = "Load from Parquet"
+    description = "Loads columns from Parquet files and merges them into the data"
+    version = VERSION
+
+    file_types = [("Parquet", "*.parquet"), ("Parquet", "*.pq")]
+
+    parameters = {
+        "columns": ArrayParam(
+            "Columns",
+            MultiParam(
+                "Column",
+                {
+                    "name": StringParam("Column Name", ""),
+                    "load": BooleanParam("Load?", True),
+                },
+            ),
+        ),
+        "filters": ArrayParam(
+            "Filters",
+            MultiParam(
+                "Filter",
+                {
+                    "column": StringParam("Column Name", ""),
+                    "operator": ChoiceParam("Operator", "==", choices=FILTER_OPERATORS),
+                    "value": StringParam("Value", ""),
+                },
+            ),
+        ),
+        "memory_map": BooleanParam("Memory-map files?", True),
+    }
+
+    def read_file_to_dataframe(self, file_param, logger, row_limit=None):
+        assert isinstance(self.parameters["columns"], ArrayParam)
+        pa = _import_pyarrow()
+        filename = file_param["filename"].value
+
+        dataset = pa.dataset.dataset(
+            filename,
+            format="parquet",
+            partitioning="hive",
+            filesystem=pa.fs.LocalFileSystem(use_mmap=self.parameters["memory_map"].value),
+        )
+
+        index_columns = pandas_index_columns(dataset.schema)
+        if not len(self.parameters["columns"]):
+            data_columns = [name for name in dataset.schema.names if name not in index_columns]
+            for n, name in enumerate(data_columns):
+                self.parameters["columns"][n]["name"].value = name
+
+        columns = [
+            pp["name"].value
+            for pp in self.parameters["columns"]
+            if pp["name"].value and pp["load"].value
+        ]
+
+        filter_ = None
+        for fp in self.parameters["filters"]:
+            if not fp["column"].value:
+                continue
+            try:
+                expression = filter_expression(
+                    pa, dataset.schema, fp["column"].value, fp["operator"].value, fp["value"].value
+                )
+            except (KeyError, ValueError, NotImplementedError) as exc:
+                logger.warning(f"Can't filter on column {fp['column'].value}: {exc}")
+                continue
+            filter_ = expression if filter_ is None else filter_ & expression
+
+        options: dict[str, Any] = {"columns": columns + index_columns, "filter": filter_}
+        if row_limit is None:
+            table = dataset.to_table(**options)
+        else:
+            table = dataset.head(row_limit, **options)
+
+        return table.to_pandas()
+
+
+class SaveParquetPlugin(DaskTransformPlugin):
+    """Saves to Parquet.  Dask DataFrames are written as a directory with
+    a file per partition, and if there are any partition columns the rows
+    are split into subdirectories by the values of those columns, eg:
+    `filename/sample=1/...`.  Otherwise pandas DataFrames are written as a
+    single file."""
+
+    name = "Parquet Save"
+    title = "Save to Parquet"
+    description = "Saves to a Parquet file or partitioned directory of Parquet files"
+    version = VERSION
+
+    file_types = [("Parquet", "*.parquet")]
+
+    parameters = {
+        "filename": FileSaveParam("Filename", file_types=file_types),
+        "compression": ChoiceParam(
+            "Compression", "snappy", choices=["None", "snappy", "gzip", "zstd"]
+        ),
+        "partition_on": ArrayParam("Partition Columns", ColumnChoiceParam("Column")),
+    }
+
+    def run(
+        self,
+        obj: Any,
+        logger: Logger,
+        row_limit: Optional[int] = None,
+    ):
+        assert isinstance(self.parameters["partition_on"], ArrayParam)
+
+        filename = self.parameters["filename"].value
+        if row_limit is not None or not filename:
+            return None
+
+        _import_pyarrow()
+
+        # multiple inputs are written to the same file
+        if isinstance(obj, Mapping):
+            obj = concat_dataframes(list(obj.values()))
+
+        compression = self.parameters["compression"].value
+        options: dict[str, Any] = {
+            "engine": "pyarrow",
+            "compression": None if compression == "None" else compression,
+        }
+        partition_on = [pp.value for pp in self.parameters["partition_on"] if pp.value]
+
+        if isinstance(obj, dd.DataFrame):
+            with DaskProgressCallback(logger):
+                write_in_place(
+                    filename,
+                    lambda path: obj.to_parquet(path, partition_on=partition_on or None, **options),
+                )
+        elif isinstance(obj, pd.DataFrame):
+            logger.progress("Writing", 0)
+            write_in_place(
+                filename,
+                lambda path: obj.to_parquet(path, partition_cols=partition_on or None, **options),
+            )
+            logger.progress("Done", 100)
+
+        return None
@@ -1,7 +1,8 @@
-import itertools
 from collections import defaultdict
+from collections.abc import Mapping
 
 import dask.dataframe as dd
+import pandas as pd  # type: ignore
 
 from countess.core.logger import Logger
 from countess.core.parameters import (ArrayParam, ChoiceParam,
@@ -13,6 +14,48 @@ VERSION = "0.0.1"
 AGG_FUNCTIONS = ["first", "sum", "count", "mean"]
 
 
+def pivot_combinations(df: pd.DataFrame) -> list[tuple]:
+    """The distinct rows of `df`, in order"""
+    return sorted(df.drop_duplicates().itertuples(index=False, name=None))
+
+
+def pivot_dataframe(
+    df: pd.DataFrame,
+    index_cols: list[str],
+    pivot_cols: list[str],
+    agg_ops: Mapping[str, list[str]],
+    combos: list[tuple],
+    squish: bool,
+) -> pd.DataFrame:
+    """Groups `df` by `index_cols` and `pivot_cols` and aggregates the columns
+    in `agg_ops`, then unstacks the pivot columns to make a column for each
+    combination of pivot values in `combos`, named like `count__bin_1__rep_2`.
+    "sum" and "count" columns are 0 where a combination doesn't occur, so
+    they keep their type.  Index columns stay as they are."""
+    pivot_ops = dict((col, ops) for col, ops in agg_ops.items() if col not in index_cols)
+    grouped = df.groupby(index_cols + pivot_cols, observed=True).agg(pivot_ops)
+    wide = grouped.unstack(pivot_cols) if len(grouped) else grouped.droplevel(pivot_cols)
+
+    result = pd.DataFrame(index=wide.index)
+    for col in index_cols:
+        if col in agg_ops:
+            result[col if squish else (col, "first")] = wide.index.get_level_values(col)
+
+    for combo in combos:
+        suffix = "".join(f"__{pc}_{pv}" for pc, pv in zip(pivot_cols, combo))
+        for col, ops in pivot_ops.items():
+            for op in ops:
+                key = (col, op) + tuple(combo)
+                values = wide[key] if key in wide else pd.Series(index=wide.index, dtype=float)
+                if op in ("sum", "count"):
+                    values = values.fillna(0).astype(grouped[col][op].dtype)
+                result[col + suffix if squish else (col + suffix, op)] = values
+
+    if not squish:
+        result.columns = pd.MultiIndex.from_tuples(result.columns)
+    return result
+
+
 class DaskPivotPlugin(DaskTransformPlugin):
     """Groups a Dask Dataframe by an arbitrary column and rolls up rows"""
 
@@ -54,67 +97,50 @@ class DaskPivotPlugin(DaskTransformPlugin):
             if isinstance(p, ChoiceParam) and p.value
         ]
 
-        # dask's built-in "dd.pivot_table" can only handle one index column
-        # and one pivot column which is too limiting.  So this is a slightly
-        # cheesy replacement.
-
         # First, collect all the aggregated columns together in one place.
         agg_cols = [
             (p.params["column"].value, p.params["function"].value)
             for p in self.parameters["agg"].params
             if isinstance(p, MultiParam) and p.params["column"].value and p.params["function"].value
         ]
-        aggregate_ops = defaultdict(list, [(c, ["first"]) for c in index_cols])
-
-        if pivot_cols:
-            # This won't run on multiindexes, but we're about to trash the indexing
-            # anyway so just drop the existing index, we don't care.
-            df = df.reset_index(drop=True)
-
-            # `pivot_product` is every combination of every pivot column, so eg: if you're
-            # pivoting on a `bin` column with values 1..4 and a `rep` column with values
-            # 1..3 you'll end up with 12 elements, [ [1,1],[1,2],[1,3],[1,4],[2,1],[2,2] etc ]
-
-            pivot_product = itertools.product(*[list(df[c].unique()) for c in pivot_cols])
-
-            # `pivot_groups` then reattaches the labels to those values, eg:
-            # [[('bin', 1), ('rep', 1)], [('bin', 1), ('rep', 2)] etc
-            pivot_groups = sorted(
-                [list(zip(pivot_cols, pivot_values)) for pivot_values in pivot_product]
-            )
-
-            # Each pivot group is a set of conditions to filter for in that pivot
-            # group.
-            dfs = []
-            for pg in pivot_groups:
-                # We first filter the source dataframe using the values in `pivot_group`
-                # then rename the aggregated columns to add a specific suffix for
-                # this group.
-                suffix = "".join([f"__{pc}_{pv}" for pc, pv in pg])
-                query = " and ".join(f"`{col}` == {repr(val)}" for col, val in pg)
-
-                # work out what columns we need to rename and accumulate the
-                # required aggregation operations in `aggregate_ops`.
-                rename_cols = {}
-                for col, agg_op in agg_cols:
-                    aggregate_ops[col + suffix].append(agg_op)
-                    rename_cols[col] = col + suffix
-
-                dfs.append(df.query(query).rename(columns=rename_cols))
-            df = dd.concat(dfs)
-
-            # XXX because of the way the concat operation collects pivot groups, a bunch of records
-            # end up getting generated with NULLs in integer columns, forcing those columns
-            # to become floats, which looks odd for a 'sum' or 'count' operation.
-        else:
-            for col, agg_op in agg_cols:
-                aggregate_ops[col].append(agg_op)
+        # Without index columns, rows are grouped by the existing index.
+        # Otherwise, the index columns are also kept as columns.
+        index_name = df.index.name
+        group_by_index = not index_cols
+        if group_by_index:
+            df = df.reset_index()
+            index_cols = [df.columns[0]]
+
+        agg_ops = defaultdict(list, [(c, ["first"]) for c in index_cols if not group_by_index])
+        for col, agg_op in agg_cols:
+            agg_ops[col].append(agg_op)
 
         # If there aren't multple aggregations for any one column,
         # squish to prevent column name mangling.
-        # XXX this could be improved to make mangling column specific.
-        if all((len(v) == 1) for k, v in aggregate_ops.items()):
-            aggregate_ops = defaultdict(list, [(k, v[0]) for k, v in aggregate_ops.items()])
-
-        # Group by the index columns and aggregate.
-        return df.groupby(index_cols or df.index).agg(aggregate_ops)
+        squish = all(len(ops) == 1 for ops in agg_ops.values())
+
+        if not pivot_cols:
+            result = df.groupby(index_cols, observed=True).agg(dict(agg_ops))
+            if squish:
+                result.columns = result.columns.get_level_values(0)
+        elif isinstance(df, dd.DataFrame):
+            # dask's built-in "dd.pivot_table" can only handle one index column
+            # and one pivot column which is too limiting.  Instead, the
+            # combinations of pivot values which occur are found first so that
+            # every partition gets the same columns, then rows are shuffled so
+            # all the rows for each index value are in one partition, then each
+            # partition is pivoted separately.
+            combos = pivot_combinations(df[pivot_cols].drop_duplicates().compute())
+            meta = pivot_dataframe(df._meta, index_cols, pivot_cols, agg_ops, combos, squish)
+            result = df.shuffle(index_cols).map_partitions(
+                pivot_dataframe, index_cols, pivot_cols, agg_ops, combos, squish, meta=meta
+            )
+        else:
+            combos = pivot_combinations(df[pivot_cols].drop_duplicates())
+            result = pivot_dataframe(df, index_cols, pivot_cols, agg_ops, combos, squish)
+
+        if group_by_index and isinstance(result, dd.DataFrame):
+            result = result.map_partitions(pd.DataFrame.rename_axis, index_name)
+        elif group_by_index:
+            result = result.rename_axis(index_name)
+        return result
@@ -1,15 +1,101 @@
-import math
+import multiprocessing
+import os
 import re
-from typing import Optional
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+from typing import Iterable, Mapping, Optional
 
 import dask.dataframe as dd
 import numpy as np
 import pandas as pd  # type: ignore
 
 from countess import VERSION
+from countess.core.logger import Logger
 from countess.core.parameters import *
 from countess.core.plugins import DaskInputPlugin, DaskTransformPlugin
-from countess.utils.dask import concat_dataframes
+from countess.utils.files import read_file_block, split_file_lines
+from countess.utils.isolation import START_METHOD
+
+
+# Number of non-matching values to show in mismatch warnings
+MISMATCH_SAMPLE_SIZE = 5
+
+
+def _cast_column(output_param, values: pd.Series) -> tuple[pd.Series, np.ndarray]:
+    """Casts `values` to `output_param`'s declared type, and returns the new
+    Series and a mask of the values which couldn't be cast."""
+    series = output_param["datatype"].cast_series(values)
+    return series, np.asarray(series.isna() & values.notna())
+
+
+def _extract_groups(
+    values: list[str],
+    codes: np.ndarray,
+    index: pd.Index,
+    compiled_re: re.Pattern,
+    output_params: list,
+    logger: Optional[Logger] = None,
+) -> dict[str, pd.Series]:
+    """Matches `compiled_re` against the distinct `values` of a column, and
+    returns the groups as columns with `index`, picked out by `codes`.  Each
+    column is cast all at once to its declared type.  Values which don't match
+    get missing values in every column, and are reported as a single warning
+    with a few examples, as are the values of each column which can't be
+    cast to its type."""
+    matches = [compiled_re.match(value) for value in values]
+
+    no_groups = (None,) * compiled_re.groups
+    groups = [match.groups() if match else no_groups for match in matches]
+    columns = list(zip(*groups))
+
+    mismatched = np.array([match is None for match in matches])[codes]
+    num_mismatched = np.count_nonzero(mismatched)
+    if num_mismatched and logger:
+        samples = pd.unique(np.array(values, dtype=object)[codes[mismatched]])
+        logger.warning(
+            f"{num_mismatched} of {len(codes)} values didn't match {compiled_re.pattern}",
+            detail=", ".join(repr(v) for v in samples[:MISMATCH_SAMPLE_SIZE]),
+        )
+
+    new_columns = {}
+    for n, (pp, column) in enumerate(zip(output_params, columns)):
+        name = pp["name"].value or f"column_{n+1}"
+        series, uncast = _cast_column(pp, pd.Series(column, dtype=object))
+        new_columns[name] = series.take(codes).set_axis(index)
+
+        num_uncast = np.count_nonzero(uncast[codes])
+        if num_uncast and logger:
+            samples = pd.unique(np.array(column, dtype=object)[codes[uncast[codes]]])
+            logger.warning(
+                f"{num_uncast} of {len(codes)} values of {name} aren't {pp['datatype'].value}",
+                detail=", ".join(repr(v) for v in samples[:MISMATCH_SAMPLE_SIZE]),
+            )
+    return new_columns
+
+
+def apply_regexes(
+    df: pd.DataFrame,
+    regexes: Mapping[Optional[str], list[tuple[re.Pattern, list]]],
+    drop_columns: Iterable[str],
+    logger: Optional[Logger] = None,
+) -> pd.DataFrame:
+    """Returns a copy of `df` with columns extracted by regular expressions.
+    `regexes` maps each input column name (or None for the index) to a list
+    of `(compiled_re, output_params)` for the regexes to match against it.
+    Each input column's distinct values are found once and shared by all of
+    its regexes, and each distinct value is only matched once."""
+    new_columns = {}
+    for column_name, column_regexes in regexes.items():
+        codes, uniques = pd.factorize(df.index if column_name is None else df[column_name])
+        # missing values have code -1, which picks out the "nan" on the end.
+        values = [str(value) for value in uniques] + ["nan"]
+        for compiled_re, output_params in column_regexes:
+            new_columns.update(
+                _extract_groups(values, codes, df.index, compiled_re, output_params, logger)
+            )
+
+    return df.assign(**new_columns).drop(columns=drop_columns)
 
 
 class RegexToolPlugin(DaskTransformPlugin):
@@ -46,17 +132,10 @@ class RegexToolPlugin(DaskTransformPlugin):
     }
 
     def run_dask(self, df, logger):
-        # prevent added columns from propagating backwards in
-        # the pipeline!
-        df = df.copy()
-
-        # the index doesn't seem to be available from within the applied function,
-        # which is annoying, so we copy it into a column here.
-        if any(rp["column"].is_index() for rp in self.parameters["regexes"]):
-            df["__index"] = df.index
-
-        # XXX this could be made more efficient by running
-        # multiple regexs in one 'apply' pass.
+        # all the regexes are applied in a single pass over each partition,
+        # grouped by the column they read.
+        regexes: dict[Optional[str], list[tuple[re.Pattern, list]]] = defaultdict(list)
+        drop_columns = set()
 
         for regex_parameter in self.parameters["regexes"]:
             compiled_re = re.compile(regex_parameter["regex"].value)
@@ -64,48 +143,93 @@ class RegexToolPlugin(DaskTransformPlugin):
             while compiled_re.groups > len(regex_parameter["output"].params):
                 regex_parameter["output"].add_row()
 
-            output_params = regex_parameter["output"].params
-            output_names = [pp["name"].value for pp in output_params]
-            output_types = [pp["datatype"].get_selected_type() for pp in output_params]
+            output_params = regex_parameter["output"].params[: compiled_re.groups]
 
             if regex_parameter["column"].is_index():
-                column_name = "__index"
+                regexes[None].append((compiled_re, output_params))
             else:
                 column_name = regex_parameter["column"].value
+                regexes[column_name].append((compiled_re, output_params))
+                if regex_parameter["drop_column"].value:
+                    drop_columns.add(column_name)
 
-            def func(row):
-                value = str(row[column_name])
-                match = compiled_re.match(value)
-                if match:
-                    return [
-                        output_params[n].datatype.cast_value(g)
-                        for n, g in enumerate(match.groups())
-                    ]
-                else:
-                    logger.warning(f"Didn't Match", detail=repr(value))
-                    return [None] * compiled_re.groups
-
-            if isinstance(df, dd.DataFrame):
-                # dask likes a hint about column types
-                meta = dict(zip(output_names, output_types))
-                re_groups_df = df.apply(func, axis=1, result_type="expand", meta=meta)
-            else:
-                # pandas infers the column types
-                re_groups_df = df.apply(func, axis=1, result_type="expand")
+        if isinstance(df, dd.DataFrame):
+            # the output types come from running it on the (empty) meta.
+            meta = apply_regexes(df._meta, regexes, drop_columns)
+            return df.map_partitions(apply_regexes, regexes, drop_columns, logger, meta=meta)
+        else:
+            return apply_regexes(df, regexes, drop_columns, logger)
 
-            for n in range(0, compiled_re.groups):
-                df[output_names[n]] = re_groups_df[n]
 
-        drop_columns = set(
-            rp["column"].value for rp in self.parameters["regexes"] if rp["drop_column"].value
-        )
-        if "__index__" in df:
-            drop_columns.add("__index")
+# Files are split into blocks of about this size, at line boundaries, which
+# are parsed in parallel processes.
+REGEX_BLOCK_SIZE = 16 * 1024 * 1024
 
-        return df.drop(columns=drop_columns)
+
+def _parse_lines(
+    lines: list[str], compiled_re: re.Pattern, output_params: list, columns: list[str]
+) -> tuple[pd.DataFrame, int, list[str], dict[str, tuple[int, list[str]]]]:
+    """Matches `compiled_re` against `lines`, and returns a DataFrame of the
+    groups of the lines which match, cast to their declared types, along
+    with the number of lines which didn't match and a few examples, and
+    the same for the values of each column which couldn't be cast."""
+    matches = [compiled_re.match(line) for line in lines]
+    mismatches = [line for line, match in zip(lines, matches) if match is None]
+    values = list(zip(*(match.groups() for match in matches if match))) or [()] * len(columns)
+
+    data = {}
+    uncast_values = {}
+    for column, pp, column_values in zip(columns, output_params, values):
+        column_series = pd.Series(column_values, dtype=object)
+        data[column], uncast = _cast_column(pp, column_series)
+        if uncast.any():
+            samples = list(column_series[uncast].unique()[:MISMATCH_SAMPLE_SIZE])
+            uncast_values[column] = (np.count_nonzero(uncast), samples)
+
+    df = pd.DataFrame(data)
+    return df, len(mismatches), mismatches[:MISMATCH_SAMPLE_SIZE], uncast_values
+
+
+def _split_lines(text: str) -> list[str]:
+    """Splits on "\n" only, unlike `str.splitlines()`, and strips any "\r"
+    from the end of each line, the same as reading lines from a file."""
+    lines = text.split("\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    return [line.rstrip("\r") for line in lines]
+
+
+def _parse_block(filename: str, start: int, end: int, skip_first: bool, *args):
+    """Parses the lines in a byte range of `filename`: see `_parse_lines`"""
+    lines = _split_lines(read_file_block(filename, start, end).decode("utf-8"))
+    return _parse_lines(lines[1:] if skip_first else lines, *args)
+
+
+def _parse_first_lines(filename: str, skip_first: bool, row_limit: int, *args):
+    """Parses lines from the start of `filename` until `row_limit` lines have
+    matched, giving up after `100 * row_limit` lines"""
+    num_matched = 0
+    with open(filename, "r", encoding="utf-8", newline="\n") as fh:
+        if skip_first:
+            fh.readline()
+        for _ in range(100):
+            lines = [line.rstrip("\n").rstrip("\r") for line in islice(fh, row_limit)]
+            if not lines:
+                break
+            result = _parse_lines(lines, *args)
+            yield result
+            num_matched += len(result[0])
+            if num_matched >= row_limit:
+                break
 
 
 class RegexReaderPlugin(DaskInputPlugin):
+    """Loads line-delimited files by matching a regular expression against
+    each line.  Files are memory-mapped and split into blocks at line
+    boundaries, which are parsed in parallel processes, each producing a
+    DataFrame of typed columns.  Lines which don't match are skipped and
+    reported as a single warning."""
+
     name = "Regex Reader"
     title = "Load arbitrary data from line-delimited files"
     description = """Loads arbitrary data from line-delimited files, applying a regular expression
@@ -135,8 +259,6 @@ class RegexReaderPlugin(DaskInputPlugin):
     }
 
     def read_file_to_dataframe(self, file_param, logger, row_limit=None):
-        pdfs = []
-
         compiled_re = re.compile(self.parameters["regex"].value)
 
         while compiled_re.groups > len(self.parameters["output"].params):
@@ -148,33 +270,58 @@ class RegexReaderPlugin(DaskInputPlugin):
             p.name.value or f"column_{n+1}"
             for n, p in enumerate(output_parameters)
             if p.index.value
-        ] or None
-
-        records = []
-        with open(file_param["filename"].value, "r") as fh:
-            for num, line in enumerate(fh):
-                if num == 0 and self.parameters["skip"].value:
-                    continue
-                match = compiled_re.match(line)
-                if match:
-                    records.append(
-                        (
-                            output_parameters[n].datatype.cast_value(g)
-                            for n, g in enumerate(match.groups())
+        ]
+
+        filename = file_param["filename"].value
+        skip = self.parameters["skip"].value
+        args = (compiled_re, output_parameters, columns)
+
+        if row_limit is not None:
+            results = list(_parse_first_lines(filename, skip, row_limit, *args))
+        else:
+            blocks = split_file_lines(filename, REGEX_BLOCK_SIZE)
+            if len(blocks) <= 1:
+                results = [_parse_block(filename, start, end, skip, *args) for start, end in blocks]
+            else:
+                # worker processes aren't forked from this one, as that's
+                # not safe while other threads (eg: Dask's) hold locks.
+                max_workers = min(os.cpu_count() or 1, len(blocks))
+                mp_context = multiprocessing.get_context(START_METHOD)
+                with ProcessPoolExecutor(max_workers, mp_context=mp_context) as executor:
+                    results = list(
+                        executor.map(
+                            _parse_block,
+                            repeat(filename),
+                            [start for start, _ in blocks],
+                            [end for _, end in blocks],
+                            [skip and num == 0 for num in range(len(blocks))],
+                            *(repeat(arg) for arg in args),
                         )
                     )
-                else:
-                    logger.warning(f"Row {num+1} did not match", detail=line)
-                if row_limit is not None:
-                    if len(records) >= row_limit or num > 100 * row_limit:
-                        break
-                elif len(records) >= 100000:
-                    pdfs.append(
-                        pd.DataFrame.from_records(records, columns=columns, index=index_columns)
-                    )
-                    records = []
 
-        if len(records):
-            pdfs.append(pd.DataFrame.from_records(records, columns=columns, index=index_columns))
+        if not results:
+            results = [_parse_lines([], *args)]
+
+        num_mismatched = sum(r[1] for r in results)
+        if num_mismatched:
+            samples = [line for r in results for line in r[2]][:MISMATCH_SAMPLE_SIZE]
+            logger.warning(
+                f"{num_mismatched} lines of {filename} didn't match",
+                detail=", ".join(repr(line) for line in samples),
+            )
+
+        for column, pp in zip(columns, output_parameters):
+            num_uncast = sum(r[3][column][0] for r in results if column in r[3])
+            if num_uncast:
+                samples = [v for r in results if column in r[3] for v in r[3][column][1]]
+                logger.warning(
+                    f"{num_uncast} values of {column} in {filename} aren't {pp.datatype.value}",
+                    detail=", ".join(repr(v) for v in samples[:MISMATCH_SAMPLE_SIZE]),
+                )
 
-        return concat_dataframes(pdfs)
+        df = pd.concat([r[0] for r in results], ignore_index=True)
+        if row_limit is not None:
+            df = df.head(row_limit)
+        if index_columns:
+            df = df.set_index(index_columns)
+        return df
@@ -0,0 +1,204 @@
+"""Utility functions for reading and writing compressed files.  Decompression
+happens on a separate thread so that parsing doesn't stall waiting for zlib,
+and BGZF files (as produced by `bgzip`) are decompressed block-parallel."""
+
+import gzip
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator, Optional
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+# size of reads from the underlying file
+READ_SIZE = 1024 * 1024
+
+# number of decompressed blocks which can be waiting for the reader
+QUEUE_SIZE = 16
+
+# number of BGZF blocks (each up to 64kB) to decompress in parallel at once
+BGZF_BATCH_SIZE = 64
+
+
+def _is_bgzf(header: bytes) -> bool:
+    """BGZF files are gzip files with a 'BC' extra subfield in every block header"""
+    return (
+        len(header) >= 16
+        and header[:2] == GZIP_MAGIC
+        and header[3] & 4 != 0
+        and header[12:14] == b"BC"
+    )
+
+
+def _read_gzip_blocks(fh: BinaryIO) -> Iterator[bytes]:
+    """Decompress a gzip file (possibly consisting of several concatenated
+    gzip members) a block at a time."""
+    decompressor = zlib.decompressobj(wbits=31)
+    in_member = False
+    while True:
+        data = fh.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            in_member = True
+            yield decompressor.decompress(data)
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(wbits=31)
+            in_member = False
+    yield decompressor.flush()
+    if in_member and not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def _read_bgzf_raw_blocks(fh: BinaryIO) -> Iterator[bytes]:
+    """Split a BGZF file into its (still compressed) blocks, using the
+    block size stored in each block's header."""
+    while True:
+        header = fh.read(18)
+        if not header:
+            return
+        if len(header) < 18:
+            raise EOFError("Compressed file ended in a BGZF block header")
+        if not _is_bgzf(header):
+            raise ValueError("Invalid BGZF block header")
+        (block_size,) = struct.unpack("<H", header[16:18])
+        rest = fh.read(block_size + 1 - len(header))
+        if len(rest) < block_size + 1 - len(header):
+            raise EOFError("Compressed file ended before the end of a BGZF block")
+        yield header + rest
+
+
+def _read_bgzf_blocks(fh: BinaryIO) -> Iterator[bytes]:
+    """Decompress a BGZF file, decompressing batches of blocks in parallel.
+    zlib releases the GIL so this makes good use of threads."""
+    raw_blocks = _read_bgzf_raw_blocks(fh)
+    with ThreadPoolExecutor() as executor:
+        while True:
+            batch = [block for _, block in zip(range(BGZF_BATCH_SIZE), raw_blocks)]
+            if not batch:
+                return
+            yield from executor.map(lambda block: zlib.decompress(block, wbits=31), batch)
+
+
+def _import_zstandard():
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError as exc:
+        raise ImportError("zstd compression requires the 'zstandard' package") from exc
+    return zstandard
+
+
+def _read_zstd_blocks(fh: BinaryIO) -> Iterator[bytes]:
+    reader = _import_zstandard().ZstdDecompressor().stream_reader(fh, read_across_frames=True)
+    while True:
+        data = reader.read(READ_SIZE)
+        if not data:
+            return
+        yield data
+
+
+class ThreadedBlockReader(io.RawIOBase):
+    """A read-only raw file which takes its data from an iterator of blocks
+    of bytes, which is run in a background thread."""
+
+    def __init__(self, blocks: Iterator[bytes], close_callback=None):
+        super().__init__()
+        self._queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+        self._buffer = b""
+        self._eof = False
+        self._stop = threading.Event()
+        self._close_callback = close_callback
+        self._thread = threading.Thread(target=self._producer, args=(blocks,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _producer(self, blocks: Iterator[bytes]):
+        try:
+            for block in blocks:
+                if block and not self._put(block):
+                    return
+            self._put(None)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            self._put(exc)
+        finally:
+            if hasattr(blocks, "close"):
+                blocks.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._eof:
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, Exception):
+                self._eof = True
+                raise item
+            else:
+                self._buffer = item
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            if self._close_callback:
+                self._close_callback()
+        super().close()
+
+
+def open_compressed(filename: str | os.PathLike) -> BinaryIO:
+    """Opens `filename` for reading in binary mode.  Files compressed with
+    gzip, bgzip or zstd are detected from their first few bytes, not the
+    filename, and are transparently decompressed on a background thread."""
+
+    # pylint: disable=consider-using-with
+    fh = open(filename, "rb")
+    header = fh.peek(18)[:18]
+
+    if header.startswith(ZSTD_MAGIC):
+        blocks = _read_zstd_blocks(fh)
+    elif _is_bgzf(header):
+        blocks = _read_bgzf_blocks(fh)
+    elif header.startswith(GZIP_MAGIC):
+        blocks = _read_gzip_blocks(fh)
+    else:
+        return fh
+
+    return io.BufferedReader(ThreadedBlockReader(blocks, fh.close), READ_SIZE)  # type: ignore
+
+
+def compress_bytes(data: bytes, compression: Optional[str]) -> bytes:
+    """Compresses `data` with `compression`, which is "gzip", "zstd" or None.
+    Both formats allow compressed blocks to be concatenated, so blocks can be
+    compressed in parallel and then written to the same file in order."""
+    if compression is None:
+        return data
+    elif compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    elif compression == "zstd":
+        return _import_zstandard().ZstdCompressor().compress(data)
+    else:
+        raise ValueError(f"Unknown compression {compression}")
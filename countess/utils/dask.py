@@ -14,6 +14,14 @@ def empty_dask_dataframe() -> dd.DataFrame:
     return edf
 
 
+def dataframe_memory_usage(df) -> int:
+    """Bytes used by a pandas DataFrame, including its index and the contents
+    of object columns.  Dask DataFrames are lazy so they count as 0."""
+    if isinstance(df, pd.DataFrame):
+        return int(df.memory_usage(index=True, deep=True).sum())
+    return 0
+
+
 def crop_dataframe(
     df: pd.DataFrame | dd.DataFrame, row_limit: Optional[int]
 ) -> pd.DataFrame | dd.DataFrame:
@@ -29,11 +37,21 @@ def crop_dataframe(
     return df
 
 
+def is_empty_dataframe(df: pd.DataFrame | dd.DataFrame) -> bool:
+    """Checks if `df` is empty without computing anything: pandas DataFrames
+    are empty if they have no rows, but the number of rows in a Dask DataFrame
+    isn't known until it is computed, so they're only empty if they have no
+    columns (like `empty_dask_dataframe()`)."""
+    if isinstance(df, pd.DataFrame):
+        return len(df) == 0
+    return len(df.columns) == 0
+
+
 def concat_dataframes(dfs: Collection[pd.DataFrame | dd.DataFrame]) -> pd.DataFrame | dd.DataFrame:
     """Concat dask dataframes, but include special cases for 0 and 1 inputs"""
 
     # extra special case for empty dataframes
-    dfs = [df for df in dfs if len(df) > 0]
+    dfs = [df for df in dfs if not is_empty_dataframe(df)]
 
     if len(dfs) == 0:
         return empty_dask_dataframe()
@@ -53,7 +71,7 @@ def merge_dataframes(dfs: list[dd.DataFrame | pd.DataFrame], how: str = "outer")
         return empty_dask_dataframe()
 
     left, *rest = dfs
-    if isinstance(left, pd.Dataframe):
+    if isinstance(left, pd.DataFrame):
         left = dd.from_pandas(left, npartitions=1)
     for right in rest:
         left = left.merge(right, how=how)
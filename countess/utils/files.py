@@ -0,0 +1,56 @@
+"""Utility functions for reading and writing files"""
+
+import mmap
+import os
+import shutil
+import tempfile
+from typing import Any, Callable
+
+
+def write_in_place(filename: str, write: Callable[[str], Any]) -> Any:
+    """Calls `write` with a temporary path alongside `filename` to write a
+    file or directory to, and then renames that into place, replacing any
+    previous file or directory.  Returns whatever `write` returns.  If
+    `write` fails, `filename` is left as it was and the temporary path is
+    cleaned up, so a partly written result is never seen."""
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    temp_dir = tempfile.mkdtemp(dir=dirname, prefix=f".{basename}.", suffix=".tmp")
+    try:
+        temp_path = os.path.join(temp_dir, basename)
+        result = write(temp_path)
+        # directories can't be renamed over, so the old one is moved out of
+        # the way first (into the temporary directory, to be cleaned up).
+        if os.path.isdir(filename) or (os.path.isdir(temp_path) and os.path.exists(filename)):
+            os.replace(filename, os.path.join(temp_dir, "previous"))
+        os.replace(temp_path, filename)
+        return result
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def split_file_lines(filename: str, block_size: int) -> list[tuple[int, int]]:
+    """Splits `filename` into `(start, end)` byte ranges of about `block_size`,
+    each of which starts at the start of a line, so that the blocks can be
+    parsed separately.  Lines are delimited by "\\n" only.  The file is
+    memory-mapped, so only the pages around the splits are read."""
+    file_size = os.path.getsize(filename)
+    if file_size == 0:
+        return []
+    offsets = [0]
+    with open(filename, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while offsets[-1] + block_size < file_size:
+            end_of_line = mm.find(b"\n", offsets[-1] + block_size)
+            if end_of_line < 0 or end_of_line + 1 >= file_size:
+                break
+            offsets.append(end_of_line + 1)
+    offsets.append(file_size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_file_block(filename: str, start: int, end: int) -> bytes:
+    """Reads the bytes from `start` to `end` of `filename`, through a memory
+    map so that they're copied straight from the page cache."""
+    if start >= end:
+        return b""
+    with open(filename, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[start:end]
@@ -0,0 +1,234 @@
+"""Utility functions for running untrusted or badly behaved code over a
+DataFrame in a child process, with limits on its CPU time, memory and
+elapsed time, so that it can't freeze or take down the main process.
+
+Children are started from a fork server where possible, since forking
+the main process directly while other threads (eg: Dask's) hold locks can
+leave the child deadlocked.  So `func` and the DataFrame are sent to the
+child, but the numeric columns of the DataFrame and of the result go
+through shared memory rather than being pickled, and are used from there
+without being copied: read-only in the child, and by the result in the
+parent.  Limits on CPU time and
+memory need the `resource` module, and are ignored where it isn't
+available."""
+
+import multiprocessing
+import os
+import signal
+import weakref
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Optional
+
+import numpy as np
+import pandas as pd  # type: ignore
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # type: ignore
+
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class _SharedMemory(SharedMemory):
+    """Shared memory can't be closed while arrays are still using it, so
+    this doesn't complain about being garbage collected while they are (eg:
+    at exit).  The memory stays mapped until the process exits."""
+
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+
+# shared memory whose arrays are gone, to be closed the next time it's safe to
+_unused_shared_memory: list[SharedMemory] = []
+
+
+class ResourceLimitError(RuntimeError):
+    """Raised when code run by `run_isolated` exceeds one of its limits"""
+
+
+def _virtual_memory_size() -> Optional[int]:
+    try:
+        with open("/proc/self/statm", "rb") as fh:
+            return int(fh.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _set_limit(which: int, value: int):
+    _, hard = resource.getrlimit(which)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(which, (value, hard))
+
+
+def _set_limits(cpu_limit: Optional[int], memory_limit: Optional[int]):
+    if resource is None:
+        return
+    if cpu_limit:
+        # CPU time used by the parent process isn't counted in the child.
+        _set_limit(resource.RLIMIT_CPU, cpu_limit)
+    if memory_limit:
+        # The child starts off with all of the parent's address space, so
+        # the limit is on how much more it can allocate.
+        vsize = _virtual_memory_size()
+        if vsize is not None:
+            _set_limit(resource.RLIMIT_AS, vsize + memory_limit)
+
+
+def _export_dataframe(df: pd.DataFrame) -> tuple[pd.DataFrame, list[tuple[int, Any, str, str]]]:
+    """Copies the numeric columns of `df` into shared memory.  Returns the
+    other columns and, for each shared column, its position, name, dtype
+    and shared memory name."""
+    positions = []
+    shared_columns = []
+    for position, (name, series) in enumerate(df.items()):
+        if isinstance(series.dtype, np.dtype) and series.dtype.kind in "biufc" and len(series):
+            values = series.to_numpy()
+            shm = SharedMemory(create=True, size=values.nbytes)
+            np.ndarray(values.shape, values.dtype, buffer=shm.buf)[:] = values
+            shared_columns.append((position, name, values.dtype.str, shm.name))
+            shm.close()
+        else:
+            positions.append(position)
+    return df.iloc[:, positions], shared_columns
+
+
+def _close_unused_shared_memory():
+    while _unused_shared_memory:
+        _unused_shared_memory.pop().close()
+
+
+def _import_dataframe(
+    df: pd.DataFrame,
+    shared_columns: list[tuple[int, Any, str, str]],
+    unlink: bool = True,
+    writeable: bool = True,
+) -> pd.DataFrame:
+    """Puts the columns from `_export_dataframe` back together.  The shared
+    columns aren't copied: they're arrays using the shared memory, which
+    stays mapped until they're gone.  If `unlink` is set, the shared
+    memory's name is removed, so it's freed along with the arrays."""
+    _close_unused_shared_memory()
+    columns = [(name, series.to_numpy()) for name, series in df.items()]
+    for position, name, dtype, shm_name in shared_columns:
+        shm = _SharedMemory(name=shm_name)
+        if unlink:
+            shm.unlink()
+        values = np.frombuffer(shm.buf, np.dtype(dtype), count=len(df))
+        values.flags.writeable = writeable
+        weakref.finalize(values, _unused_shared_memory.append, shm).atexit = False
+        columns.insert(position, (name, values))
+
+    # columns are keyed by position, as names may be repeated, and kept as
+    # they are rather than consolidated into new blocks.
+    result = pd.DataFrame(
+        dict((position, values) for position, (_, values) in enumerate(columns)),
+        index=df.index,
+        copy=False,
+    )
+    result.columns = pd.Index([name for name, _ in columns], tupleize_cols=False)
+    return result
+
+
+def _unlink_shared_columns(shared_columns: list[tuple[int, Any, str, str]]):
+    for _, _, _, shm_name in shared_columns:
+        try:
+            shm = SharedMemory(name=shm_name)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _exit_error(exitcode, cpu_limit, memory_limit) -> RuntimeError:
+    """Works out why a child process died without sending a result.  It's
+    killed by SIGXCPU when it exceeds its CPU time limit, or SIGKILL when
+    it reaches the hard limit or the kernel runs out of memory."""
+    if resource is not None:
+        if cpu_limit and exitcode in (-signal.SIGXCPU, -signal.SIGKILL):
+            return ResourceLimitError(f"exceeded its CPU time limit of {cpu_limit} seconds")
+        if memory_limit and exitcode == -signal.SIGKILL:
+            return ResourceLimitError(f"exceeded its memory limit of {memory_limit} bytes")
+    return RuntimeError(f"Process exited with code {exitcode}")
+
+
+def _run_child(conn, func, exported_df, cpu_limit, memory_limit):
+    try:
+        # the parent frees the input's shared memory once the child is done,
+        # and until then it's shared, so the child can't change it.
+        df = _import_dataframe(*exported_df, unlink=False, writeable=False)
+        _set_limits(cpu_limit, memory_limit)
+        result = func(df)
+        conn.send(("ok", _export_dataframe(result)))
+    except MemoryError:
+        conn.send(("limit", f"exceeded its memory limit of {memory_limit} bytes"))
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        conn.send(("error", f"{type(exc).__name__}: {exc}"))
+    finally:
+        conn.close()
+
+
+def run_isolated(
+    func: Callable[[pd.DataFrame], pd.DataFrame],
+    df: pd.DataFrame,
+    cpu_limit: Optional[int] = None,
+    memory_limit: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> pd.DataFrame:
+    """Runs `func(df)` in a child process and returns the result.  `cpu_limit`
+    is in seconds of CPU time, `memory_limit` in bytes and `timeout` in
+    seconds of elapsed time.  Raises ResourceLimitError if a limit is
+    exceeded, or RuntimeError if `func` raises an exception.  `func` has
+    to be picklable, eg: a module level function or a functools.partial of
+    one."""
+
+    # shared memory is tracked by one process for both parent and child,
+    # so it isn't cleaned up when the child exits.
+    resource_tracker.ensure_running()
+
+    context = multiprocessing.get_context(START_METHOD)
+    if START_METHOD == "forkserver":
+        # modules loaded by the fork server don't need importing by each child.
+        # This only has an effect before the first child is started.
+        module = getattr(getattr(func, "func", func), "__module__", None)
+        context.set_forkserver_preload([__name__] + ([module] if module else []))
+
+    exported_df = _export_dataframe(df)
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(  # type: ignore[attr-defined]
+        target=_run_child,
+        args=(child_conn, func, exported_df, cpu_limit, memory_limit),
+        daemon=True,
+    )
+    try:
+        process.start()
+    except BaseException:
+        _unlink_shared_columns(exported_df[1])
+        raise
+    child_conn.close()
+
+    try:
+        if not parent_conn.poll(timeout or None):
+            raise ResourceLimitError(f"exceeded its timeout of {timeout} seconds")
+        try:
+            status, value = parent_conn.recv()
+        except EOFError as exc:
+            process.join()
+            raise _exit_error(process.exitcode, cpu_limit, memory_limit) from exc
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        parent_conn.close()
+        _unlink_shared_columns(exported_df[1])
+
+    if status == "limit":
+        raise ResourceLimitError(value)
+    elif status == "error":
+        raise RuntimeError(value)
+    return _import_dataframe(*value)
@@ -0,0 +1,132 @@
+"""Utility functions for compact encodings of DNA sequences.  There are two
+encodings, both 2 bits per base: `pack_sequences` packs each sequence into a
+uint64, which is fastest to group and join on but only holds ACGT sequences
+of up to 31 bases, and `pack_sequences_bytes` packs each into a bytes object,
+which holds sequences of any length, and stores sequences which aren't all
+ACGT (eg: with Ns) as they are.  `unpack_sequences` unpacks either."""
+
+from typing import Sequence
+
+import numpy as np
+
+# Each base is packed into 2 bits, below a leading 1 bit which marks the
+# length of the sequence, so a uint64 can hold up to 31 bases.
+MAX_PACKED_LENGTH = 31
+
+# Packed bytes start with a byte which is 1 + the number of unused bases
+# at the end of the last byte, or RAW_PREFIX for sequences which aren't all
+# ACGT and are stored as they are.
+RAW_PREFIX = b"\x00"
+
+BASES = b"ACGT"
+
+_PACK_TABLE = np.full(256, 255, dtype=np.uint8)
+for _code, _base in enumerate(BASES):
+    _PACK_TABLE[_base] = _code
+    _PACK_TABLE[ord(chr(_base).lower())] = _code
+
+_UNPACK_TABLE = np.frombuffer(BASES, dtype=np.uint8)
+
+# the smallest packed value for each length of sequence
+_LENGTH_THRESHOLDS = np.array(
+    [1 << (2 * length) for length in range(0, MAX_PACKED_LENGTH + 1)], dtype=np.uint64
+)
+
+
+def pack_sequences(sequences: Sequence[bytes]) -> tuple[np.ndarray, np.ndarray]:
+    """Packs DNA `sequences` into an array of uint64, 2 bits per base.
+    Returns `(packed, valid)` where `valid` is a boolean array which is False
+    for sequences which can't be packed (because they contain bases other than
+    ACGT or are longer than MAX_PACKED_LENGTH): these are packed as 0."""
+    lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+    packed = np.zeros(len(sequences), dtype=np.uint64)
+    valid = lengths <= MAX_PACKED_LENGTH
+
+    # sequences of each length are packed together as a 2D array of codes
+    for length in np.unique(lengths[valid]):
+        (indices,) = np.nonzero(lengths == length)
+        data = b"".join([sequences[i] for i in indices])
+        codes = _PACK_TABLE[np.frombuffer(data, dtype=np.uint8)].reshape(len(indices), length)
+        values = np.ones(len(indices), dtype=np.uint64)
+        for column in codes.T:
+            values = (values << np.uint64(2)) | column.astype(np.uint64)
+        packed[indices] = values
+        valid[indices] = (codes != 255).all(axis=1)
+
+    packed[~valid] = 0
+    return packed, valid
+
+
+def pack_sequences_bytes(sequences: Sequence[bytes]) -> list[bytes]:
+    """Packs DNA `sequences` of any length into bytes, 4 bases per byte (see
+    RAW_PREFIX).  Sequences which contain bases other than ACGT are kept as
+    they are, so nothing is lost."""
+    lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+    packed: list[bytes] = [b""] * len(sequences)
+
+    # sequences of each length are packed together as a 2D array of codes,
+    # padded out to a whole number of bytes.
+    for length in np.unique(lengths):
+        (indices,) = np.nonzero(lengths == length)
+        data = b"".join([sequences[i] for i in indices])
+        codes = _PACK_TABLE[np.frombuffer(data, dtype=np.uint8)].reshape(len(indices), length)
+        valid = (codes != 255).all(axis=1)
+
+        num_bytes = (length + 3) // 4
+        padded = np.zeros((len(indices), num_bytes * 4), dtype=np.uint8)
+        padded[:, :length] = np.where(valid[:, np.newaxis], codes, 0)
+        quads = padded.reshape(len(indices), num_bytes, 4)
+        values = np.empty((len(indices), num_bytes + 1), dtype=np.uint8)
+        values[:, 0] = 1 + num_bytes * 4 - length
+        values[:, 1:] = (
+            (quads[:, :, 0] << 6) | (quads[:, :, 1] << 4) | (quads[:, :, 2] << 2) | quads[:, :, 3]
+        )
+
+        rows = values.tobytes()
+        for i, n in enumerate(indices):
+            if valid[i]:
+                packed[n] = rows[i * (num_bytes + 1) : (i + 1) * (num_bytes + 1)]
+            else:
+                packed[n] = RAW_PREFIX + sequences[n]
+
+    return packed
+
+
+def _unpack_sequences_bytes(packed: Sequence[bytes]) -> list[str]:
+    lengths = np.fromiter((len(p) for p in packed), dtype=np.int64, count=len(packed))
+    is_raw = np.array([p[:1] == RAW_PREFIX for p in packed], dtype=bool)
+    sequences = [p[1:].decode("ascii") if raw else "" for p, raw in zip(packed, is_raw)]
+
+    for length in np.unique(lengths[~is_raw]):
+        (indices,) = np.nonzero((lengths == length) & ~is_raw)
+        values = np.frombuffer(b"".join([packed[i] for i in indices]), dtype=np.uint8)
+        values = values.reshape(len(indices), length)
+        shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+        codes = (values[:, 1:, np.newaxis] >> shifts) & 3
+        data = _UNPACK_TABLE[codes.reshape(len(indices), -1)].tobytes()
+        row_length = (length - 1) * 4
+        for i, n in enumerate(indices):
+            sequence_length = row_length - (int(values[i, 0]) - 1)
+            sequences[n] = data[i * row_length : i * row_length + sequence_length].decode("ascii")
+
+    return sequences
+
+
+def unpack_sequences(packed: np.ndarray | Sequence[bytes]) -> list[str]:
+    """Unpacks an array of values from `pack_sequences`, or a sequence of
+    bytes from `pack_sequences_bytes`, into strings"""
+    if isinstance(next(iter(packed), None), bytes):
+        return _unpack_sequences_bytes(list(packed))
+    packed = np.asarray(packed, dtype=np.uint64)
+    lengths = np.maximum(np.searchsorted(_LENGTH_THRESHOLDS, packed, side="right") - 1, 0)
+    sequences = [""] * len(packed)
+
+    for length in np.unique(lengths):
+        (indices,) = np.nonzero(lengths == length)
+        shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+        codes = (packed[indices, np.newaxis] >> shifts) & np.uint64(3)
+        data = _UNPACK_TABLE[codes].tobytes()
+        for i, n in enumerate(indices):
+            sequences[n] = data[i * length : (i + 1) * length].decode("ascii")
+
+    return sequences
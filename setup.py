@@ -22,12 +22,15 @@ setup(
                 'load_fastq = countess.plugins.fastq:LoadFastqPlugin',
                 'load_hdf = countess.plugins.hdf5:LoadHdfPlugin',
                 'load_csv = countess.plugins.csv:LoadCsvPlugin',
+                'load_parquet = countess.plugins.parquet:LoadParquetPlugin',
                 'log_score = countess.plugins.log_score:LogScorePlugin',
                 'group_by = countess.plugins.group_by:GroupByPlugin',
                 'embed_py = countess.plugins.embed_python:EmbeddedPythonPlugin',
                 'pivot = countess.plugins.pivot:DaskPivotPlugin',
                 'join = countess.plugins.join:DaskJoinPlugin',
                 'save_csv = countess.plugins.csv:SaveCsvPlugin',
+                'save_parquet = countess.plugins.parquet:SaveParquetPlugin',
+                'save_hdf = countess.plugins.hdf5:StoreHdfPlugin',
                 'regex_tool = countess.plugins.regex:RegexToolPlugin',
                 'regex_reader = countess.plugins.regex:RegexReaderPlugin',
             ],
@@ -51,7 +54,13 @@ setup(
                 'mypy~=1.0.1',
                 'pylint~=2.16',
                 'types-ttkthemes~=3.2',
-            ]
+            ],
+            'zstd': [
+                'zstandard>=0.19',
+            ],
+            'arrow': [
+                'pyarrow>=7.0',
+            ],
         },
         license = 'BSD',
         license_files = ('LICENSE.txt',),